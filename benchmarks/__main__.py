@@ -0,0 +1,279 @@
+import sys
+import json
+import hashlib
+import argparse
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from functools import partial
+from statistics import median
+from typing import Callable, Dict, List, Optional, Tuple
+from unittest import mock
+
+from prepare_tool.core import Core
+from prepare_tool.const import COMPRESSION_PROFILES, DEFAULT_COMPRESSION_PROFILE
+from prepare_tool.download import Downloader, Fetcher
+from prepare_tool.report import MiB, Measurement, measureTime
+from prepare_tool.validate import Validator
+from prepare_tool.generate import ArchiveGenerator, StyleSheetGenerator, WebFontGenerator, webfont
+from prepare_tool.generate.webfont import readFontData
+
+from .fonts import buildSyntheticFont
+
+BASELINE_VERSION = 2
+DEFAULT_BASELINE_PATH = Path(__file__).parent.joinpath('./baseline.json')
+FLAVORS = {'ttf': False, 'cff': True}
+# How subsets of packages read their source font, from disk for every subset as before, or once per weight
+FONT_READ_MODES = {'reload': readFontData.__wrapped__, 'in-memory': readFontData}
+
+
+def cli():
+    parser = argparse.ArgumentParser(prog='benchmarks', description='Benchmark generators with synthetic fonts.')
+    parser.add_argument('--glyphs', dest='glyph_count', type=int, default=20000, help='Number of glyphs per font.')
+    parser.add_argument('--flavor', dest='flavors', choices=list(FLAVORS.keys()), action='append')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=1, help='Number of worker processes.')
+    parser.add_argument(
+        '--compression-profile',
+        dest='compression_profiles',
+        choices=list(COMPRESSION_PROFILES.keys()),
+        action='append',
+        help='Compression profiles of webfonts to compare, the default profile only by default.'
+    )
+    parser.add_argument(
+        '--package',
+        dest='package_paths',
+        type=Path,
+        action='append',
+        help='Benchmark subsetting of a package JSON, e.g. example/*.json, instead of synthetic fonts.'
+    )
+    parser.add_argument(
+        '--download-cache-dir', dest='download_cache_dir', type=Path, help='Cache directory of downloaded files.'
+    )
+    parser.add_argument('--repeat', dest='repeat', type=int, default=3, help='Take the median of N runs.')
+    parser.add_argument('--baseline', dest='baseline_path', type=Path, default=DEFAULT_BASELINE_PATH)
+    parser.add_argument('--update-baseline', dest='update_baseline', action='store_true')
+    parser.add_argument(
+        '--threshold', dest='threshold', type=float, default=0.2, help='Allowed slowdown ratio against the baseline.'
+    )
+    args = vars(parser.parse_args())
+    return main(**args)
+
+
+def createPackageJson(json_path: Path, font_path: Path, flavor: str) -> None:
+    with open(font_path, 'rb') as font_read_io:
+        sha256 = hashlib.sha256(font_read_io.read()).hexdigest()
+
+    package = {
+        '$schema': 'https://schemas.openfonts.jp/package/v0.1.0/schema.json',
+        'id': f"benchmark-{flavor}",
+        'name': f"Benchmark {flavor.upper()}",
+        'version': '1.0.0',
+        'homepage': 'https://openfonts.jp/',
+        'license': 'OFL-1.1',
+        'authors': ['OpenFonts.jp'],
+        'sources':
+            [
+                {
+                    'url': f"https://openfonts.jp/{font_path.name}",
+                    'fonts': {
+                        'normal': {
+                            'filename': font_path.name,
+                            'sha256': sha256
+                        }
+                    },
+                }
+            ],
+        'features': {},
+        'category': 'Gothic',
+        'characters': ['Kanji'],
+        'copyrights': ['Copyright (C) OpenFonts.jp'],
+    }
+    with open(json_path, 'w', encoding='utf-8') as json_write_io:
+        json_write_io.write(json.dumps(package, indent=2))
+
+
+def runFlavor(flavor: str, glyph_count: int, jobs: int, repeat: int, compression_profiles: List[str],
+              work_dir: Path) -> Dict[str, dict]:
+    font_path = work_dir.joinpath(f"./Benchmark{flavor.upper()}-Regular.{'otf' if FLAVORS[flavor] else 'ttf'}")
+    glyph_count = buildSyntheticFont(font_path, f"Benchmark {flavor.upper()}", glyph_count, cff=FLAVORS[flavor])
+    font_size = font_path.stat().st_size
+
+    json_path = work_dir.joinpath(f"./{flavor}.json")
+    createPackageJson(json_path, font_path, flavor)
+
+    output_dir = work_dir.joinpath(f"./output-{flavor}")
+
+    def openCore() -> Core:
+        # Every run starts cold, nothing hashed, parsed or read by an earlier run is reused
+        readFontData.cache_clear()
+        core = Core(json_path, output_dir)
+        # Skip downloading, the font is already on disk
+        extracted_path = core.directories.tmp.joinpath(font_path.name)
+        extracted_path.write_bytes(font_path.read_bytes())
+        core.indexFile(extracted_path)
+        return core
+
+    components: List[Tuple[str, Callable[[Core], object]]] = [
+        ('validator', lambda core: Validator(core).validate()),
+        ('archive', lambda core: ArchiveGenerator(core).generate()),
+    ]
+    for profile in compression_profiles:
+        # Names of the default profile are kept, so that existing baselines still apply
+        name = 'webfont' if profile == DEFAULT_COMPRESSION_PROFILE else f"webfont.{profile}"
+        components.append((name, partial(runWebFont, jobs=jobs, compression_profile=profile)))
+    components.append(('stylesheet', lambda core: StyleSheetGenerator(core).generate()))
+
+    results: Dict[str, dict] = {}
+    for name, run in components:
+        measurements: List[Measurement] = []
+        for _ in range(repeat):
+            with openCore() as core:
+                measurements.append(measure(name, partial(run, core)))
+
+        results[f"{flavor}.{name}"] = summarize(measurements, glyph_count, font_size)
+    return results
+
+
+def runPackage(json_path: Path, repeat: int, fetcher: Fetcher, work_dir: Path) -> Dict[str, dict]:
+    output_dir = work_dir.joinpath('./output-packages')
+
+    def openCore() -> Core:
+        readFontData.cache_clear()
+        core = Core(json_path, output_dir)
+        # Sources are downloaded once by the fetcher and only extracted again for each run
+        Downloader(core, fetcher=fetcher).download()
+        Validator(core).validate()
+        return core
+
+    with openCore() as core:
+        package_id = core.package.id
+        fonts = [font for source in core.package.sources for _, font in source.fonts if font is not None]
+        glyph_count = sum(core.getFontMetadata(font).glyph_count for font in fonts)
+        font_size = sum(core.findFontfilePath(font).stat().st_size for font in fonts)
+
+    results: Dict[str, dict] = {}
+    for mode, read_font_data in FONT_READ_MODES.items():
+        name = f"{package_id}.webfont.{mode}"
+        measurements: List[Measurement] = []
+        for _ in range(repeat):
+            # Subsets are generated in this process, so that the read mode applies to them
+            with openCore() as core, mock.patch.object(webfont, 'readFontData', read_font_data):
+                run = partial(runWebFont, core, jobs=1, compression_profile=DEFAULT_COMPRESSION_PROFILE)
+                measurements.append(measure(name, run))
+        results[name] = summarize(measurements, glyph_count, font_size)
+    return results
+
+
+def summarize(measurements: List[Measurement], glyph_count: int, font_size: int) -> dict:
+    wall_time = median(measurement.wall_time for measurement in measurements)
+    return {
+        'wall_time': wall_time,
+        'cpu_time': median(measurement.cpu_time for measurement in measurements),
+        'glyphs_per_second': glyph_count / wall_time,
+        'megabytes_per_second': font_size / MiB / wall_time,
+        'bytes_out': measurements[-1].bytes_out,
+    }
+
+
+def runWebFont(core: Core, jobs: int, compression_profile: str) -> int:
+    # Subsets are always written, outputs of the previous profile are overwritten
+    WebFontGenerator(core, jobs=jobs, compression_profile=compression_profile).generate()
+    return sum(subset_file.stat().st_size for subset_file in core.directories.webfonts.glob('**/*.woff*'))
+
+
+def measure(name: str, run: Callable[[], object]) -> Measurement:
+    measurement = Measurement(stage=name)
+    with measureTime(measurement):
+        bytes_out = run()
+    measurement.bytes_out = bytes_out if isinstance(bytes_out, int) else 0
+    return measurement
+
+
+def loadBaseline(baseline_path: Path, glyph_count: int) -> Optional[Dict[str, dict]]:
+    if not baseline_path.is_file():
+        return None
+    with open(baseline_path, 'r', encoding='utf-8') as baseline_read_io:
+        data = json.loads(baseline_read_io.read())
+    if data.get('version') != BASELINE_VERSION or data.get('glyphs') != glyph_count:
+        print(f"{baseline_path} was measured with another setting, skipping comparison.", file=sys.stderr)
+        return None
+    return data['results']
+
+
+def main(
+    glyph_count: int,
+    flavors: Optional[List[str]],
+    jobs: int,
+    compression_profiles: Optional[List[str]],
+    package_paths: Optional[List[Path]],
+    download_cache_dir: Optional[Path],
+    repeat: int,
+    baseline_path: Path,
+    update_baseline: bool,
+    threshold: float,
+) -> int:
+    if package_paths is not None:
+        return mainPackages(package_paths, download_cache_dir, repeat)
+
+    results: Dict[str, dict] = {}
+    with TemporaryDirectory(prefix='openfontsjp-benchmark-') as work_dir:
+        for flavor in flavors or list(FLAVORS.keys()):
+            results.update(
+                runFlavor(
+                    flavor, glyph_count, jobs, repeat, compression_profiles or [DEFAULT_COMPRESSION_PROFILE],
+                    Path(work_dir)
+                )
+            )
+
+    baseline = loadBaseline(baseline_path, glyph_count) if not update_baseline else None
+    regressions: List[str] = []
+
+    print(f"{'benchmark':<24} {'wall(s)':>9} {'glyphs/s':>11} {'MB/s':>9} {'out(KiB)':>9} {'baseline':>9}")
+    for name, result in results.items():
+        line = (
+            f"{name:<24} {result['wall_time']:>9.3f} {result['glyphs_per_second']:>11.0f} "
+            f"{result['megabytes_per_second']:>9.2f} {result['bytes_out'] / 1024:>9.1f}"
+        )
+        if baseline is not None and name in baseline:
+            ratio = result['wall_time'] / baseline[name]['wall_time'] - 1
+            line += f" {ratio:>+8.1%}"
+            if ratio > threshold:
+                line += '  REGRESSION'
+                regressions.append(name)
+        print(line)
+
+    if update_baseline:
+        with open(baseline_path, 'w', encoding='utf-8') as baseline_write_io:
+            data = {'version': BASELINE_VERSION, 'glyphs': glyph_count, 'results': results}
+            baseline_write_io.write(json.dumps(data, indent=2, sort_keys=True))
+
+    if len(regressions) != 0:
+        print(f"{len(regressions)} benchmarks are slower than the baseline by over {threshold:.0%}.", file=sys.stderr)
+        return 1
+    return 0
+
+
+def mainPackages(package_paths: List[Path], download_cache_dir: Optional[Path], repeat: int) -> int:
+    '''
+    Compare reading the source font from disk for every subset with reading it once per weight.
+    Packages are real fonts which change with their versions, so they are not compared with the baseline.
+    '''
+    results: Dict[str, dict] = {}
+    with TemporaryDirectory(prefix='openfontsjp-benchmark-') as work_dir, Fetcher(download_cache_dir) as fetcher:
+        for package_path in package_paths:
+            results.update(runPackage(package_path, repeat, fetcher, Path(work_dir)))
+
+    print(f"{'benchmark':<40} {'wall(s)':>9} {'glyphs/s':>11} {'MB/s':>9} {'out(KiB)':>9} {'reload':>9}")
+    for name, result in results.items():
+        line = (
+            f"{name:<40} {result['wall_time']:>9.3f} {result['glyphs_per_second']:>11.0f} "
+            f"{result['megabytes_per_second']:>9.2f} {result['bytes_out'] / 1024:>9.1f}"
+        )
+        reload_name = name.replace('.in-memory', '.reload')
+        if reload_name != name and reload_name in results:
+            line += f" {result['wall_time'] / results[reload_name]['wall_time'] - 1:>+8.1%}"
+        print(line)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(cli())
@@ -0,0 +1,73 @@
+from pathlib import Path
+from typing import Dict, List, Set
+from fontTools.fontBuilder import FontBuilder
+from fontTools.pens.t2CharStringPen import T2CharStringPen
+from fontTools.pens.ttGlyphPen import TTGlyphPen
+
+from prepare_tool.unicodes import getUnicodeGroupIndex
+
+UNITS_PER_EM = 1000
+ADVANCE_WIDTH = 1000
+
+
+def getCodepoints(glyph_count: int) -> List[int]:
+    # Spread the encoded glyphs over every group like a real CJK font
+    groups = [list(reversed(group.codepoints)) for group in getUnicodeGroupIndex()]
+    codepoints: Set[int] = set()
+    while len(codepoints) < glyph_count and any(len(group) != 0 for group in groups):
+        for group in groups:
+            if len(group) != 0 and len(codepoints) < glyph_count:
+                codepoints.add(group.pop())
+    return sorted(codepoints)
+
+
+def buildSyntheticFont(font_path: Path, family_name: str, glyph_count: int, cff: bool) -> int:
+    '''
+    Build a font with glyph_count glyphs. Glyphs beyond the codepoints of groups are left unencoded.
+    '''
+    codepoints = getCodepoints(glyph_count - 1)
+    glyph_order = ['.notdef'] + [
+        f"uni{codepoint:04X}" if codepoint < 0x10000 else f"u{codepoint:05X}" for codepoint in codepoints
+    ]
+    glyph_order += [f"glyph{idx:05d}" for idx in range(len(glyph_order), glyph_count)]
+
+    builder = FontBuilder(UNITS_PER_EM, isTTF=not cff)
+    builder.setupGlyphOrder(glyph_order)
+    builder.setupCharacterMap(dict(zip(codepoints, glyph_order[1:])))
+
+    if cff:
+        charstrings: Dict[str, object] = {}
+        for idx, glyph_name in enumerate(glyph_order):
+            pen = T2CharStringPen(ADVANCE_WIDTH, None)
+            drawGlyph(pen, idx)
+            charstrings[glyph_name] = pen.getCharString()
+        builder.setupCFF(family_name.replace(' ', ''), {'FullName': family_name}, charstrings, {})
+    else:
+        glyphs: Dict[str, object] = {}
+        for idx, glyph_name in enumerate(glyph_order):
+            pen = TTGlyphPen(None)
+            drawGlyph(pen, idx)
+            glyphs[glyph_name] = pen.glyph()
+        builder.setupGlyf(glyphs)
+
+    builder.setupHorizontalMetrics({glyph_name: (ADVANCE_WIDTH, 50) for glyph_name in glyph_order})
+    builder.setupHorizontalHeader(ascent=880, descent=-120)
+    builder.setupNameTable({'familyName': family_name, 'styleName': 'Regular', 'copyright': 'Benchmark'})
+    builder.setupOS2(sTypoAscender=880, sTypoDescender=-120, usWinAscent=880, usWinDescent=120)
+    builder.setupPost()
+    builder.save(str(font_path))
+    return len(glyph_order)
+
+
+def drawGlyph(pen, idx: int) -> None:
+    # A few strokes which differ per glyph, roughly the size of a simple kanji outline
+    for stroke in range(4 + idx % 5):
+        x = 80 + (idx * 37 + stroke * 131) % 760
+        y = 60 + (idx * 53 + stroke * 97) % 700
+        width = 40 + (idx + stroke) % 80
+        height = 120 + (idx * 7 + stroke * 11) % 120
+        pen.moveTo((x, y))
+        pen.lineTo((x + width, y))
+        pen.lineTo((x + width + stroke * 3, y + height))
+        pen.lineTo((x, y + height))
+        pen.closePath()
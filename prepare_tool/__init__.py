@@ -1,11 +1,23 @@
+import os
+import sys
+import json
+import time
 import argparse
+from contextlib import ExitStack
 from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 
-from prepare_tool.core import Core
-from prepare_tool.models import Package
-from prepare_tool.download import Downloader
-from prepare_tool.validate import Validator
-from prepare_tool.generate import ArchiveGenerator, StyleSheetGenerator, WebFontGenerator
+from prepare_tool.const import ARCHIVE_EXTENSION, COMPRESSION_PROFILES, DEFAULT_COMPRESSION_PROFILE, FILE_DIR
+
+# Modules of each subcommand are imported when the subcommand runs, so that e.g. `schema` does not
+# pay for importing fontTools, requests and the generators.
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
+    from prepare_tool.core import Core
+    from prepare_tool.cache import OutputCache
+    from prepare_tool.download import Fetcher
+    from prepare_tool.plan import BuildPlanner
+    from prepare_tool.report import BuildReport
 
 
 def cli():
@@ -18,46 +30,438 @@ def cli():
 
     validate_command_parser = subparsers.add_parser('validate', help='Validate hashes of font.')
     validate_command_parser.add_argument('json_path', metavar='json_file', type=Path, help='JSON file')
+    validate_command_parser.add_argument(
+        '--download-cache-dir', dest='download_cache_dir', type=Path, help='Cache directory of downloaded files.'
+    )
+    validate_command_parser.add_argument(
+        '--full-download',
+        dest='full_download',
+        action='store_true',
+        help='Download whole archives instead of reading only fonts in zip archives with range requests.'
+    )
 
     generate_command_parser = subparsers.add_parser('generate', help='Generate webfonts.')
     generate_command_parser.add_argument('json_path', metavar='json_file', type=Path, help='JSON file')
-    generate_command_parser.add_argument('--output-dir', dest='output_dir', type=Path, required=True)
-    generate_command_parser.add_argument('--no-generate-archive', dest='generate_archive', action='store_false')
-    generate_command_parser.add_argument('--no-generate-webfonts', dest='generate_webfonts', action='store_false')
-    generate_command_parser.add_argument('--no-generate-css', dest='generate_css', action='store_false')
+    add_generate_arguments(generate_command_parser)
+
+    generate_batch_command_parser = subparsers.add_parser(
+        'generate-batch', help='Generate webfonts of multiple packages.'
+    )
+    generate_batch_command_parser.add_argument(
+        'json_paths', metavar='json_file_or_dir', type=Path, nargs='+', help='JSON files or directories of them'
+    )
+    generate_batch_command_parser.add_argument(
+        '--summary', dest='summary_path', type=Path, help='Write a JSON summary of results.'
+    )
+    add_generate_arguments(generate_batch_command_parser)
+
+    group_unicodes_command_parser = subparsers.add_parser(
+        'group-unicodes', help='Regenerate unicode groups from character frequencies of a corpus.'
+    )
+    group_unicodes_command_parser.add_argument(
+        'corpus_paths', metavar='corpus_file_or_dir', type=Path, nargs='+', help='Text files or directories of them'
+    )
+    group_unicodes_command_parser.add_argument(
+        '--group-size', dest='group_size', type=int, default=200, help='Number of codepoints per group.'
+    )
+    group_unicodes_command_parser.add_argument(
+        '--groups-dir', dest='groups_dir', type=Path, default=FILE_DIR.UNICODE_TEXT, help='Directory of groups.'
+    )
+    group_unicodes_command_parser.add_argument(
+        '--dry-run', dest='dry_run', action='store_true', help='Print the fetch counts only.'
+    )
 
     args = vars(parser.parse_args())
     return main(parser=parser, **args)
 
 
+def add_generate_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--output-dir', dest='output_dir', type=Path, required=True)
+    parser.add_argument('--no-generate-archive', dest='generate_archive', action='store_false')
+    parser.add_argument('--no-generate-webfonts', dest='generate_webfonts', action='store_false')
+    parser.add_argument('--no-generate-css', dest='generate_css', action='store_false')
+    parser.add_argument(
+        '--download-cache-dir', dest='download_cache_dir', type=Path, help='Cache directory of downloaded files.'
+    )
+    parser.add_argument(
+        '--extract-all',
+        dest='extract_all',
+        action='store_true',
+        help='Extract every file of archives, not only the fonts of the package.'
+    )
+    parser.add_argument('--jobs', dest='jobs', type=int, default=1, help='Number of worker processes.')
+    parser.add_argument(
+        '--cache-dir', dest='cache_dir', type=Path, help='Cache directory of webfonts and font metadata.'
+    )
+    parser.add_argument(
+        '--cache-max-size', dest='cache_max_size', type=int, default=1024, help='Cache size limit in MiB.'
+    )
+    parser.add_argument(
+        '--archive-format',
+        dest='archive_format',
+        choices=list(ARCHIVE_EXTENSION.keys()),
+        default='gz',
+        help='Compression format of the archive.'
+    )
+    parser.add_argument(
+        '--compression-profile',
+        dest='compression_profile',
+        choices=list(COMPRESSION_PROFILES.keys()),
+        default=DEFAULT_COMPRESSION_PROFILE,
+        help='Compression effort of WOFF and WOFF2, fast is meant for preview builds.'
+    )
+    parser.add_argument(
+        '--group-budget',
+        dest='group_budget',
+        type=int,
+        help='Regroup unicodes per font so that each subset holds about this many KiB of glyph data.'
+    )
+    parser.add_argument(
+        '--split-css', dest='split_css', action='store_true', help='Also write a stylesheet for each weight.'
+    )
+    parser.add_argument(
+        '--hashed-assets',
+        dest='hashed_assets',
+        action='store_true',
+        help='Refer to subsets by content hash, precompress stylesheets and write a deployment manifest.'
+    )
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true', help='Print the build plan only.')
+    parser.add_argument('--force', dest='force', action='store_true', help='Rebuild regardless of the last build.')
+    parser.add_argument(
+        '--report', dest='report_path', type=Path, help='Print a summary and write a JSON report of each stage.'
+    )
+    parser.add_argument('--profile', dest='profile_path', type=Path, help='Write cProfile stats of generating subsets.')
+
+
 def print_schema():
+    from prepare_tool.models import Package
+
     print(Package.schema_json(indent=2, sort_keys=True))
 
 
+def create_output_cache(options: dict) -> Optional['OutputCache']:
+    from prepare_tool.cache import OutputCache
+
+    if options['cache_dir'] is None:
+        return None
+    return OutputCache(options['cache_dir'], max_size=options['cache_max_size'] * 1024 * 1024)
+
+
+def create_build_planner(prepare_tool: 'Core', options: dict) -> 'BuildPlanner':
+    from prepare_tool.plan import BuildPlanner, STAGE_ARCHIVE, STAGE_WEBFONT, STAGE_STYLESHEET
+
+    stages: List[str] = []
+    if options['generate_archive'] is True:
+        stages.append(STAGE_ARCHIVE)
+    if options['generate_webfonts'] is True:
+        stages.append(STAGE_WEBFONT)
+    if options['generate_css'] is True:
+        stages.append(STAGE_STYLESHEET)
+    return BuildPlanner(
+        prepare_tool,
+        stages=stages,
+        force=options['force'],
+        archive_format=options['archive_format'],
+        group_budget=get_group_budget(options),
+        split_css=options['split_css'],
+        compression_profile=options['compression_profile'],
+        hashed_assets=options['hashed_assets'],
+    )
+
+
+def get_group_budget(options: dict) -> Optional[int]:
+    if options['group_budget'] is None:
+        return None
+    return options['group_budget'] * 1024
+
+
+def get_archive_threads(options: dict, subsetting: bool) -> int:
+    jobs = options['jobs']
+    cpu_count = os.cpu_count() or 1
+    if jobs == 1:
+        return 1
+    # Worker processes keep subsetting while the archive is written, so it only gets the CPUs they leave
+    if subsetting:
+        return max(1, cpu_count - jobs)
+    return min(jobs, cpu_count)
+
+
+def create_build_report(options: dict) -> Optional['BuildReport']:
+    from prepare_tool.report import BuildReport
+
+    if options['report_path'] is None and options['profile_path'] is None:
+        return None
+    return BuildReport(profile=options['profile_path'] is not None)
+
+
+def finish_build_report(report: Optional['BuildReport'], options: dict):
+    if report is None:
+        return
+    if options['report_path'] is not None:
+        print(report.summary(), file=sys.stderr)
+        report.write(options['report_path'])
+    if options['profile_path'] is not None:
+        report.writeProfile(options['profile_path'])
+
+
+def get_font_paths(prepare_tool: 'Core') -> List[Path]:
+    package = prepare_tool.package
+    return [
+        prepare_tool.findFontfilePath(font) for source in package.sources
+        for _, font in source.fonts if font is not None
+    ]
+
+
+def generate_package(
+    prepare_tool: 'Core',
+    options: dict,
+    cache: Optional['OutputCache'] = None,
+    fetcher: Optional['Fetcher'] = None,
+    executor: Optional['Executor'] = None,
+    report: Optional['BuildReport'] = None,
+):
+    from prepare_tool.plan import STAGE_ARCHIVE, STAGE_WEBFONT, STAGE_STYLESHEET
+    from prepare_tool.report import measurePhase, measureStage
+
+    package_id = prepare_tool.package.id
+
+    with measureStage(report, 'plan', package_id):
+        planner = create_build_planner(prepare_tool, options)
+        plan = planner.plan()
+    if options['dry_run'] is True:
+        print(f"[{package_id}]")
+        print(plan.describe())
+        return
+    if plan.empty:
+        return
+
+    from prepare_tool.download import Downloader
+    from prepare_tool.validate import Validator
+    from prepare_tool.generate import ArchiveGenerator, StyleSheetGenerator, WebFontGenerator
+
+    webfont_generator: Optional[WebFontGenerator] = None
+    if plan.shouldBuild(STAGE_WEBFONT):
+        webfont_generator = WebFontGenerator(
+            prepare_tool,
+            jobs=options['jobs'],
+            cache=cache,
+            executor=executor,
+            plan=plan,
+            report=report,
+            group_budget=get_group_budget(options),
+            compression_profile=options['compression_profile'],
+        )
+
+    # Name records and cmap coverage are read once per font and shared by the webfont and stylesheet stages
+    needs_metadata = plan.shouldBuild(STAGE_WEBFONT) or plan.shouldBuild(STAGE_STYLESHEET)
+    try:
+        # Each source is validated and starts subsetting as soon as it is extracted,
+        # while the following sources are still downloading.
+        with measureStage(report, 'pipeline', package_id) as measurement:
+            validator = Validator(prepare_tool)
+            downloader = Downloader(
+                prepare_tool,
+                cache_dir=options['download_cache_dir'],
+                fetcher=fetcher,
+                extract_all=options['extract_all'],
+            )
+            sources = downloader.iterSources()
+            while True:
+                with measurePhase(measurement, 'download'):
+                    source = next(sources, None)
+                if source is None:
+                    break
+                with measurePhase(measurement, 'validate'):
+                    validator.validateSource(source)
+                if needs_metadata:
+                    with measurePhase(measurement, 'metadata'):
+                        for weight, font in source.fonts:
+                            if font is None:
+                                continue
+                            metadata = prepare_tool.getFontMetadata(font)
+                            if report is not None:
+                                report.addFont(package_id, weight, font.sha256, metadata)
+                if webfont_generator is not None:
+                    with measurePhase(measurement, 'subset'):
+                        webfont_generator.addSource(source)
+            measurement.bytes_in = sum(font_path.stat().st_size for font_path in get_font_paths(prepare_tool))
+
+        # Worker processes keep subsetting while the archive is written.
+        if plan.shouldBuild(STAGE_ARCHIVE):
+            with measureStage(report, 'archive', package_id) as measurement:
+                ArchiveGenerator(
+                    prepare_tool,
+                    archive_format=options['archive_format'],
+                    threads=get_archive_threads(options, subsetting=webfont_generator is not None),
+                ).generate()
+                measurement.bytes_in = sum(font_path.stat().st_size for font_path in get_font_paths(prepare_tool))
+                archive_path = prepare_tool.directories.archives.joinpath(
+                    f"./{package_id}.{ARCHIVE_EXTENSION[options['archive_format']]}"
+                )
+                measurement.bytes_out = archive_path.stat().st_size
+    except Exception:
+        if webfont_generator is not None:
+            webfont_generator.cancel()
+        raise
+
+    if webfont_generator is not None:
+        with measureStage(report, 'webfont', package_id):
+            webfont_generator.finish()
+    if plan.shouldBuild(STAGE_STYLESHEET):
+        with measureStage(report, 'stylesheet', package_id) as measurement:
+            StyleSheetGenerator(
+                prepare_tool,
+                measurement=measurement,
+                group_budget=get_group_budget(options),
+                split_css=options['split_css'],
+                hashed_assets=options['hashed_assets'],
+            ).generate()
+
+    planner.saveManifest(plan)
+
+
 def generate(json_path: Path, output_dir: Path, **options):
-    with Core(json_path, output_dir) as prepare_tool:
-        Downloader(prepare_tool).download()
-        Validator(prepare_tool).validate()
+    from prepare_tool.core import Core
+
+    cache = create_output_cache(options)
+
+    with ExitStack() as stack:
+        report = create_build_report(options)
+        if report is not None:
+            stack.enter_context(report)
+
+        with Core(json_path, output_dir, cache_dir=options['cache_dir']) as prepare_tool:
+            generate_package(prepare_tool, options, cache=cache, report=report)
+        finish_build_report(report, options)
+
+
+def generate_batch(json_paths: List[Path], output_dir: Path, summary_path: Optional[Path], **options) -> int:
+    from prepare_tool.core import Core
+    from prepare_tool.download import MAX_PENDING_SOURCES, Fetcher
+    from prepare_tool.generate.webfont import createWorkerPool
+
+    json_files: List[Path] = []
+    for json_path in json_paths:
+        if json_path.is_dir():
+            json_files.extend(sorted(json_path.glob('*.json')))
+        else:
+            json_files.append(json_path)
+
+    cache = create_output_cache(options)
+    results: List[dict] = []
+
+    with ExitStack() as stack:
+        report = create_build_report(options)
+        if report is not None:
+            stack.enter_context(report)
+        fetcher = stack.enter_context(Fetcher(options['download_cache_dir']))
+        executor = None
+        if options['jobs'] != 1:
+            executor = stack.enter_context(createWorkerPool(options['jobs']))
 
-        if options['generate_archive'] is True:
-            ArchiveGenerator(prepare_tool).generate()
-        if options['generate_webfonts'] is True:
-            WebFontGenerator(prepare_tool).generate()
-        if options['generate_css'] is True:
-            StyleSheetGenerator(prepare_tool).generate()
+        # Sources of each package to be generated, with the referer to download them with.
+        # Packages are validated later when they are generated, so they are loaded without validation here.
+        package_sources: List[List[Tuple[str, str]]] = []
+        for json_file in json_files:
+            sources: List[Tuple[str, str]] = []
+            package_sources.append(sources)
+            if options['dry_run'] is True:
+                continue
+            try:
+                with Core(json_file, output_dir, validate=False) as prepare_tool:
+                    if create_build_planner(prepare_tool, options).plan().empty:
+                        continue
+                    sources.extend(
+                        (source.url, prepare_tool.package.homepage) for source in prepare_tool.package.sources
+                    )
+            except Exception:
+                # Reported when the package itself is generated
+                continue
 
+        for index, json_file in enumerate(json_files):
+            # Sources of the next packages are downloaded while this one is generated, but only a few of them,
+            # so downloaded files do not pile up on disk.
+            upcoming_sources: Dict[str, str] = {}
+            for sources in package_sources[index + 1:]:
+                for url, referer in sources:
+                    upcoming_sources.setdefault(url, referer)
+            # Sources shared with later packages are kept after they are extracted, and downloaded only once
+            fetcher.retain(upcoming_sources.keys())
+            for url, referer in list(upcoming_sources.items())[:MAX_PENDING_SOURCES]:
+                fetcher.prefetch(url, referer)
+
+            result = {'json_path': str(json_file), 'id': None, 'status': 'success', 'error': None}
+            started_at = time.monotonic()
+            try:
+                with Core(json_file, output_dir, cache_dir=options['cache_dir']) as prepare_tool:
+                    result['id'] = prepare_tool.package.id
+                    generate_package(
+                        prepare_tool, options, cache=cache, fetcher=fetcher, executor=executor, report=report
+                    )
+            except Exception as error:
+                result['status'] = 'failure'
+                result['error'] = f"{type(error).__name__}: {error}"
+            result['elapsed'] = round(time.monotonic() - started_at, 3)
+            results.append(result)
+
+            print(f"{result['status']:<8} {result['elapsed']:>9.3f}s  {json_file}", file=sys.stderr)
+            if result['error'] is not None:
+                print(f"    {result['error']}", file=sys.stderr)
+
+        finish_build_report(report, options)
+
+    failures = [result for result in results if result['status'] != 'success']
+    print(f"{len(results) - len(failures)} succeeded, {len(failures)} failed.", file=sys.stderr)
+
+    if summary_path is not None:
+        with open(summary_path, 'w', encoding='utf-8') as summary_write_io:
+            summary_write_io.write(json.dumps(results, indent=2, ensure_ascii=False))
+
+    return 1 if len(failures) != 0 else 0
+
+
+def validate(json_path: Path, download_cache_dir: Optional[Path], full_download: bool):
+    from prepare_tool.core import Core
+    from prepare_tool.download import Downloader
+    from prepare_tool.validate import Validator
 
-def validate(json_path: Path):
     with Core(json_path, output_dir=Path()) as prepare_tool:
-        Downloader(prepare_tool).download()
+        downloader = Downloader(prepare_tool, cache_dir=download_cache_dir)
+        if full_download:
+            downloader.download()
+        else:
+            downloader.hashSources()
         Validator(prepare_tool).validate()
 
 
+def group_unicodes(corpus_paths: List[Path], group_size: int, groups_dir: Path, dry_run: bool):
+    from prepare_tool.unicodes import UnicodeGroupIndex
+    from prepare_tool.unicodes.frequency import CharacterFrequency, FrequencyGrouper, currentGroups, writeGroups
+
+    frequency = CharacterFrequency()
+    frequency.addCorpus(corpus_paths)
+
+    index = UnicodeGroupIndex.build(groups_dir)
+    before = currentGroups(index)
+    after = FrequencyGrouper(index, group_size=group_size).group(frequency)
+
+    print(f"{len(frequency.pages)} pages, {len(frequency.counts)} distinct characters")
+    print(f"before: {len(before)} groups, {frequency.countFetches(before):.2f} subsets per page")
+    print(f"after:  {len(after)} groups, {frequency.countFetches(after):.2f} subsets per page")
+
+    if not dry_run:
+        writeGroups(after, groups_dir)
+
+
 def main(parser: argparse.ArgumentParser, command: str, **args):
     if command == 'schema':
         print_schema()
     elif command == 'generate':
         generate(**args)
+    elif command == 'generate-batch':
+        return generate_batch(**args)
+    elif command == 'group-unicodes':
+        group_unicodes(**args)
     elif command == 'validate':
         validate(**args)
     else:
@@ -0,0 +1,76 @@
+import os
+import json
+import hashlib
+from pathlib import Path
+from shutil import copyfile
+from tempfile import NamedTemporaryFile
+from typing import Any, List, Tuple
+
+CACHE_KEY_VERSION = 1
+
+
+class OutputCache():
+    '''
+    Content-addressed store of generated files.
+    Entries are keyed by a hash of every input of the generation step and evicted in LRU order.
+    '''
+    def __init__(self, cache_dir: Path, max_size: int) -> None:
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def createKey(**inputs: Any) -> str:
+        serialized = json.dumps({'version': CACHE_KEY_VERSION, **inputs}, sort_keys=True, default=str)
+        return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+    def restore(self, key: str, files: List[Tuple[str, Path]]) -> bool:
+        entries = [(self.__entryPath(key, suffix), dest_path) for suffix, dest_path in files]
+        if not all(entry_path.is_file() for entry_path, _ in entries):
+            return False
+
+        for entry_path, dest_path in entries:
+            os.utime(entry_path)
+            linkOrCopy(entry_path, dest_path)
+        return True
+
+    def store(self, key: str, files: List[Tuple[str, Path]]) -> None:
+        for suffix, src_path in files:
+            entry_path = self.__entryPath(key, suffix)
+            entry_path.parent.mkdir(parents=True, exist_ok=True)
+
+            with NamedTemporaryFile(dir=entry_path.parent, delete=False) as tmp_file:
+                tmp_path = Path(tmp_file.name)
+            copyfile(src_path, tmp_path)
+            # Restored subsets are hardlinks of the entry, so they get its mode
+            moveIntoPlace(tmp_path, entry_path)
+
+    def evict(self) -> None:
+        entries = [(entry_path, entry_path.stat()) for entry_path in self.cache_dir.glob('*/*') if entry_path.is_file()]
+        total_size = sum(stat.st_size for _, stat in entries)
+
+        for entry_path, stat in sorted(entries, key=lambda entry: entry[1].st_mtime):
+            if total_size <= self.max_size:
+                break
+            entry_path.unlink()
+            total_size -= stat.st_size
+
+    def __entryPath(self, key: str, suffix: str) -> Path:
+        return self.cache_dir.joinpath(f"./{key[:2]}/{key}{suffix}")
+
+
+def moveIntoPlace(tmp_path: Path, dest_path: Path) -> None:
+    # Temporary files are only readable by the owner, unlike files written with open()
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, dest_path)
+
+
+def linkOrCopy(src_path: Path, dest_path: Path) -> None:
+    # Never write through an existing hardlink, it may point into the cache.
+    if dest_path.exists():
+        dest_path.unlink()
+    try:
+        os.link(src_path, dest_path)
+    except OSError:
+        copyfile(src_path, dest_path)
@@ -42,6 +42,30 @@ NAME_ID = __NameId()
 WEIGHT_NUMBER = __WeightNumber()
 FILE_DIR = __FileDir()
 
+
+@dataclass(frozen=True)
+class CompressionProfile():
+    # zlib level of WOFF, mapped to a number of zopfli iterations when zopfli is used
+    zlib_level: int
+    zopfli: bool
+    # Brotli quality and window bits of WOFF2
+    brotli_quality: int
+    brotli_window: int
+
+
+# 'balanced' is the default of fontTools, which was used before profiles were selectable.
+COMPRESSION_PROFILES = {
+    'fast': CompressionProfile(zlib_level=1, zopfli=False, brotli_quality=4, brotli_window=18),
+    'balanced': CompressionProfile(zlib_level=6, zopfli=False, brotli_quality=11, brotli_window=22),
+    'max': CompressionProfile(zlib_level=9, zopfli=True, brotli_quality=11, brotli_window=24),
+}
+DEFAULT_COMPRESSION_PROFILE = 'balanced'
+
+ARCHIVE_EXTENSION = {
+    'gz': 'tar.gz',
+    'xz': 'tar.xz',
+}
+
 FAMILY_RELATED_NAME_ID = [
     NAME_ID.LEGACY_FAMILY,
     NAME_ID.TRUETYPE_UNIQUE_ID,
@@ -1,10 +1,13 @@
 import json
-from typing import List
+from typing import Dict, List, Optional, Set
 from dataclasses import dataclass
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
-from prepare_tool.models import Package, Font
+from prepare_tool.models import Package, Font, constructPackage
+from prepare_tool.fonts import FontFileCache
+from prepare_tool.fonts.metadata import FontMetadata, FontMetadataCache
+from prepare_tool.unicodes import getUnicodeGroupIndex
 
 
 @dataclass()
@@ -13,16 +16,17 @@ class Directories():
     output: Path
     archives: Path
     webfonts: Path
+    manifests: Path
 
 
 class Core:
-    def __init__(self, json_file: Path, output_dir: Path) -> None:
+    def __init__(
+        self, json_file: Path, output_dir: Path, validate: bool = True, cache_dir: Optional[Path] = None
+    ) -> None:
         if not json_file.is_file():
             raise FileNotFoundError(f"{json_file} is not found.")
 
-        with open(json_file, 'r', encoding='utf-8') as file:
-            json_dict = json.loads(file.read())
-            self.package = Package(**json_dict)
+        self.package = self.loadPackage(json_file, validate)
 
         self.__tmp_directory = TemporaryDirectory(prefix='openfontsjp-')
         self.directories = Directories(
@@ -30,11 +34,31 @@ class Core:
             output=output_dir,
             archives=output_dir.joinpath('./archives'),
             webfonts=output_dir.joinpath(f"./webfonts/{self.package.id}"),
+            manifests=output_dir.joinpath('./manifests'),
         )
 
         for dir_path in vars(self.directories).values():  # type: Path
             dir_path.mkdir(parents=True, exist_ok=True)
 
+        # SHA256 of files hashed while they were extracted
+        self.file_hashes: Dict[Path, str] = {}
+        # Filename to paths of files extracted into tmp directory
+        self.__file_index: Dict[str, Set[Path]] = {}
+        # Parsed fonts shared by all weights, e.g. faces of a TTC
+        self.fonts = FontFileCache(instance_dir=self.directories.tmp.joinpath('./.instances'))
+        # Name records and cmap coverage of fonts, kept across runs in cache_dir
+        self.font_metadata = FontMetadataCache(self.fonts, cache_dir=cache_dir)
+        # Parsed groups/*.txt shared by all generators, kept across runs in cache_dir
+        self.unicode_groups = getUnicodeGroupIndex(cache_dir)
+
+    @staticmethod
+    def loadPackage(json_file: Path, validate: bool = True) -> Package:
+        with open(json_file, 'r', encoding='utf-8') as file:
+            json_dict = json.loads(file.read())
+            if not validate:
+                return constructPackage(json_dict)
+            return Package(**json_dict)
+
     def __enter__(self):
         return self
 
@@ -42,12 +66,20 @@ class Core:
         self.cleanup()
 
     def cleanup(self) -> None:
+        self.font_metadata.close()
+        self.fonts.close()
         self.__tmp_directory.cleanup()
 
+    def indexFile(self, file_path: Path) -> None:
+        self.__file_index.setdefault(file_path.name, set()).add(file_path)
+
     def findFontfilePath(self, font: Font) -> Path:
-        matched: List[Path] = list(self.directories.tmp.glob(f"**/{font.filename}"))
+        matched: List[Path] = sorted(self.__file_index.get(font.filename, set()))
         if len(matched) == 0:
             raise Exception(f"{font.filename} is not found.")
         elif len(matched) != 1:
             raise Exception(f"2 or more files with same name as {font.filename} are found.")
         return matched[0]
+
+    def getFontMetadata(self, font: Font) -> FontMetadata:
+        return self.font_metadata.get(self.findFontfilePath(font), font.sha256, font.number)
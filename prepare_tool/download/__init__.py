@@ -1,62 +1,370 @@
 import cgi
+import json
+import hashlib
+import shutil
 import requests
-from pathlib import Path
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+from tempfile import TemporaryDirectory
+from threading import Lock
+from typing import BinaryIO, Deque, Dict, Iterable, Iterator, Optional, Set, Tuple
 from urllib.parse import urlparse
 from tarfile import TarFile
-from zipfile import ZipFile
+from zipfile import BadZipFile, ZipFile, ZipInfo
+from requests.adapters import HTTPAdapter
 
 from prepare_tool.core import Core
+from prepare_tool.models import Source
+from prepare_tool.cache import linkOrCopy
+from prepare_tool.download.remote import RemoteFile, RemoteFileChanged
 
 ZIP_FILENAME_UTF8_FLAG = 0x800
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+EXTRACT_CHUNK_SIZE = 1024 * 1024
+MAX_CONCURRENT_DOWNLOADS = 4
+MAX_DOWNLOAD_ATTEMPTS = 3
+MAX_PENDING_SOURCES = MAX_CONCURRENT_DOWNLOADS
+# Sources which can not be read with range requests, they are downloaded as a whole
+NON_ZIP_SUFFIXES = ('.tar.xz', '.ttf', '.otf', '.ttc', '.otc')
+
+
+class Fetcher():
+    '''
+    Downloads source files over a pooled session. Each URL is fetched only once per instance,
+    until it is released.
+    '''
+    def __init__(self, cache_dir: Optional[Path] = None) -> None:
+        self.__tmp_directory = TemporaryDirectory(prefix='openfontsjp-download-')
+        self.__cache_dir = cache_dir
+        self.__download_dir = cache_dir or Path(self.__tmp_directory.name)
+        self.__executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS)
+        self.__futures: Dict[str, Future] = {}
+        # URLs needed again later, which are kept when they are released
+        self.__retained_urls: Set[str] = set()
+        self.__lock = Lock()
+
+        self.__session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=MAX_CONCURRENT_DOWNLOADS, pool_maxsize=MAX_CONCURRENT_DOWNLOADS)
+        self.__session.mount('http://', adapter)
+        self.__session.mount('https://', adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.__executor.shutdown(wait=True)
+        self.__session.close()
+        self.__tmp_directory.cleanup()
+
+    def prefetch(self, url: str, referer: str) -> Future:
+        with self.__lock:
+            if url not in self.__futures:
+                self.__futures[url] = self.__executor.submit(self.__fetch, url, referer)
+            return self.__futures[url]
+
+    def fetch(self, url: str, referer: str) -> Path:
+        return self.prefetch(url, referer).result()
+
+    def retain(self, urls: Iterable[str]) -> None:
+        with self.__lock:
+            self.__retained_urls = set(urls)
+
+    def release(self, url: str) -> None:
+        '''
+        Delete a download once it is extracted, unless it is kept in the download cache or retained.
+        '''
+        with self.__lock:
+            if self.__cache_dir is not None or url in self.__retained_urls:
+                return
+            future = self.__futures.pop(url, None)
+        if future is not None:
+            future.result()
+            shutil.rmtree(self.__getDownloadDirectory(url))
+
+    def __getDownloadDirectory(self, url: str) -> Path:
+        url_digest = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return self.__download_dir.joinpath(f"./{url_digest}")
+
+    def prefetchMemberHashes(self, url: str, referer: str, font_filenames: Set[str]) -> Future:
+        '''
+        Hash fonts in a zip archive, reading only its central directory and the fonts with range requests.
+        The future resolves to None when the archive can not be read this way and has to be downloaded.
+        '''
+        return self.__executor.submit(self.__hashMembers, url, referer, font_filenames)
+
+    def __hashMembers(self, url: str, referer: str, font_filenames: Set[str]) -> Optional[Dict[str, str]]:
+        if urlparse(url).path.lower().endswith(NON_ZIP_SUFFIXES):
+            return None
+
+        try:
+            remote_file = RemoteFile.open(self.__session, url, referer)
+            if remote_file is None:
+                return None
+
+            member_hashes: Dict[str, str] = {}
+            with remote_file, ZipFile(remote_file, mode='r') as archive:
+                # Each member is streamed by one request, which ends where the next member starts
+                remote_file.addBoundaries([*(info.header_offset for info in archive.filelist), archive.start_dir])
+                for info in archive.filelist:
+                    filename = decodeZipFilename(info)
+                    if info.is_dir() or PurePosixPath(filename).name not in font_filenames:
+                        continue
+
+                    sha256 = hashlib.sha256()
+                    with archive.open(info) as file:
+                        for chunk in iter(lambda: file.read(EXTRACT_CHUNK_SIZE), b''):
+                            sha256.update(chunk)
+                    member_hashes[filename] = sha256.hexdigest()
+            return member_hashes
+        except (BadZipFile, RemoteFileChanged, requests.exceptions.RequestException):
+            # Not a zip archive, replaced on the server or the connection failed.
+            # The whole file is downloaded with retries instead.
+            return None
+
+    def __fetch(self, url: str, referer: str) -> Path:
+        download_dir = self.__getDownloadDirectory(url)
+        download_dir.mkdir(parents=True, exist_ok=True)
+
+        for attempt in range(1, MAX_DOWNLOAD_ATTEMPTS + 1):
+            try:
+                # Partial downloads left by a failed attempt are resumed with a range request.
+                return self.__fetchToDirectory(url, referer, download_dir)
+            except requests.exceptions.RequestException as error:
+                if attempt == MAX_DOWNLOAD_ATTEMPTS or not isRetryable(error):
+                    raise Exception(f"Failed to download {url}: {error}") from error
+        raise AssertionError('unreachable')
+
+    def __fetchToDirectory(self, url: str, referer: str, download_dir: Path) -> Path:
+        meta_path = download_dir.joinpath('./meta.json')
+        part_meta_path = download_dir.joinpath('./meta.json.part')
+
+        meta = self.__readMeta(meta_path)
+        part_meta = self.__readMeta(part_meta_path)
+        headers: Dict[str, str] = {'Referer': referer}
+
+        cached_path = download_dir.joinpath(meta['file_name']) if meta else None
+        if cached_path is not None and cached_path.is_file():
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        part_path = download_dir.joinpath('./download.part')
+        resume_from = part_path.stat().st_size if part_path.is_file() else 0
+        if resume_from > 0 and part_meta and part_meta.get('etag'):
+            headers['Range'] = f"bytes={resume_from}-"
+            headers['If-Range'] = part_meta['etag']
+
+        with self.__session.get(url, headers=headers, stream=True) as res:
+            if res.status_code == 304 and cached_path is not None:
+                return cached_path
+            if res.status_code == 416 and 'Range' in headers:
+                part_path.unlink()
+                return self.__fetchToDirectory(url, referer, download_dir)
+            res.raise_for_status()
+
+            _, params = cgi.parse_header(res.headers.get('content-disposition', ''))
+            file_name = params.get('filename', Path(urlparse(res.url).path).name)
+            new_meta = {
+                'url': url,
+                'file_name': file_name,
+                'etag': res.headers.get('etag'),
+                'last_modified': res.headers.get('last-modified'),
+            }
+
+            if res.status_code == 206 and 'Range' in headers:
+                mode = 'ab'
+            else:
+                mode = 'wb'
+                self.__writeMeta(part_meta_path, new_meta)
+
+            with open(part_path, mode) as file:
+                for chunk in res.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    file.write(chunk)
+
+        file_path = download_dir.joinpath(file_name)
+        part_path.replace(file_path)
+        self.__writeMeta(meta_path, new_meta)
+        part_meta_path.unlink()
+        return file_path
+
+    def __readMeta(self, meta_path: Path) -> Optional[dict]:
+        if not meta_path.is_file():
+            return None
+        with open(meta_path, 'r', encoding='utf-8') as meta_read_io:
+            return json.loads(meta_read_io.read())
+
+    def __writeMeta(self, meta_path: Path, meta: dict) -> None:
+        with open(meta_path, 'w', encoding='utf-8') as meta_write_io:
+            meta_write_io.write(json.dumps(meta))
 
 
 class Downloader():
-    def __init__(self, core: Core) -> None:
+    def __init__(
+        self,
+        core: Core,
+        cache_dir: Optional[Path] = None,
+        fetcher: Optional[Fetcher] = None,
+        extract_all: bool = False,
+    ) -> None:
         self.__core = core
+        self.__cache_dir = cache_dir
+        self.__fetcher = fetcher
+        self.__extract_all = extract_all
 
     def download(self) -> None:
-        self.__fetch()
+        for _ in self.iterSources():
+            pass
+
+    def hashSources(self) -> None:
+        '''
+        Hash fonts without downloading whole archives, for validation.
+        Fonts in zip archives are read with range requests, other sources and servers without range support
+        fall back to a full download. Fonts read remotely are indexed with their hashes but never written.
+        '''
+        if self.__fetcher is not None:
+            self.__hashSources(self.__fetcher)
+        else:
+            with Fetcher(self.__cache_dir) as fetcher:
+                self.__hashSources(fetcher)
 
-    def __fetch(self) -> None:
+    def iterSources(self) -> Iterator[Source]:
+        '''
+        Yield each source as soon as its fonts are extracted, while the following sources are still downloading.
+        '''
+        if self.__fetcher is not None:
+            yield from self.__iterSources(self.__fetcher)
+        else:
+            with Fetcher(self.__cache_dir) as fetcher:
+                yield from self.__iterSources(fetcher)
+
+    def __iterSources(self, fetcher: Fetcher) -> Iterator[Source]:
         package = self.__core.package
-        tmp_dir = self.__core.directories.tmp
+        urls = list(dict.fromkeys(source.url for source in package.sources))
+        pending: Deque[Tuple[str, Future]] = deque()
+        extracted: Set[str] = set()
 
         for source in package.sources:
-            res = requests.get(source.url, headers={'Referer': package.homepage})
-            _, params = cgi.parse_header(res.headers.get('content-disposition', ''))
-            file_name = params.get('filename', Path(urlparse(res.url).path).name)
-            file_path = tmp_dir.joinpath(file_name)
+            if source.url not in extracted:
+                # Only a few sources are downloaded ahead, and each is deleted once it is extracted,
+                # so downloaded files do not pile up on disk.
+                while len(urls) != 0 and len(pending) < MAX_PENDING_SOURCES:
+                    url = urls.pop(0)
+                    pending.append((url, fetcher.prefetch(url, package.homepage)))
+                url, future = pending.popleft()
+                self.__extract(future.result())
+                fetcher.release(url)
+                extracted.add(source.url)
+            yield source
+
+    def __hashSources(self, fetcher: Fetcher) -> None:
+        package = self.__core.package
+        tmp_dir = self.__core.directories.tmp
+        font_filenames = self.__fontFilenames()
 
-            with open(file_path, 'wb') as file:
-                file.write(res.content)
+        urls = list(dict.fromkeys(source.url for source in package.sources))
+        pending = [(url, fetcher.prefetchMemberHashes(url, package.homepage, font_filenames)) for url in urls]
+        for url, future in pending:
+            member_hashes = future.result()
+            if member_hashes is None:
+                self.__extract(fetcher.fetch(url, package.homepage))
+                fetcher.release(url)
+                continue
 
-            if file_name.endswith('.tar.xz'):
-                return self.__extractTarXz(file_path)
-            elif file_name.endswith('.zip'):
-                return self.__extractZip(file_path)
-            elif file_name.endswith('.ttf') or file_name.endswith('.otf'):
-                return None
-            else:
-                raise Exception(f"{file_name} is unsupported file.")
+            for filename, hash_hex in member_hashes.items():
+                member_path = getMemberPath(tmp_dir, filename)
+                self.__core.file_hashes[member_path] = hash_hex
+                self.__core.indexFile(member_path)
+
+    def __extract(self, file_path: Path) -> None:
+        tmp_dir = self.__core.directories.tmp
+        file_name = file_path.name
+
+        if file_name.endswith('.tar.xz'):
+            self.__extractTarXz(file_path)
+        elif file_name.endswith('.zip'):
+            self.__extractZip(file_path)
+        elif file_name.endswith(('.ttf', '.otf', '.ttc', '.otc')):
+            linkOrCopy(file_path, tmp_dir.joinpath(file_name))
+            self.__core.indexFile(tmp_dir.joinpath(file_name))
+        else:
+            raise Exception(f"{file_name} is unsupported file.")
+
+    def __fontFilenames(self) -> Set[str]:
+        package = self.__core.package
+        return {font.filename for source in package.sources for _, font in source.fonts if font is not None}
 
     def __extractZip(self, file_path: Path) -> None:
         tmp_dir = self.__core.directories.tmp
+        font_filenames = self.__fontFilenames()
+
         with ZipFile(file_path, mode='r') as archive:
             for info in archive.filelist:
                 if info.is_dir():
                     continue
 
-                filename = info.filename
-                if (info.flag_bits & ZIP_FILENAME_UTF8_FLAG) == 0:
-                    # Redecode as cp932 (Shift-JIS)
-                    filename = filename.encode('cp437').decode('cp932')
+                filename = decodeZipFilename(info)
+
+                # Only fonts referenced by the package are needed
+                if not self.__extract_all and PurePosixPath(filename).name not in font_filenames:
+                    continue
 
-                export_filepath = tmp_dir.joinpath(filename)
+                export_filepath = getMemberPath(tmp_dir, filename)
                 export_filepath.parent.mkdir(parents=True, exist_ok=True)
-                with archive.open(info) as file, open(export_filepath, mode='wb') as export:
-                    export.write(file.read())
+                with archive.open(info) as file:
+                    self.__core.file_hashes[export_filepath] = self.__exportAndHash(file, export_filepath)
+                self.__core.indexFile(export_filepath)
 
     def __extractTarXz(self, file_path: Path) -> None:
         tmp_dir = self.__core.directories.tmp
+        font_filenames = self.__fontFilenames()
+
         with TarFile.open(file_path, mode='r:xz') as archive:
-            archive.extractall(tmp_dir)
+            for member in archive:
+                if not member.isfile():
+                    continue
+                # Only fonts referenced by the package are needed
+                if not self.__extract_all and PurePosixPath(member.name).name not in font_filenames:
+                    continue
+
+                export_filepath = getMemberPath(tmp_dir, member.name)
+                export_filepath.parent.mkdir(parents=True, exist_ok=True)
+                with archive.extractfile(member) as file:
+                    self.__core.file_hashes[export_filepath] = self.__exportAndHash(file, export_filepath)
+                self.__core.indexFile(export_filepath)
+
+    def __exportAndHash(self, file: BinaryIO, export_filepath: Path) -> str:
+        sha256 = hashlib.sha256()
+        with open(export_filepath, mode='wb') as export:
+            for chunk in iter(lambda: file.read(EXTRACT_CHUNK_SIZE), b''):
+                sha256.update(chunk)
+                export.write(chunk)
+        return sha256.hexdigest()
+
+
+def isRetryable(error: requests.exceptions.RequestException) -> bool:
+    # Client errors such as 404 are returned again by the next attempt
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code >= 500
+    return True
+
+
+def getMemberPath(base_dir: Path, filename: str) -> Path:
+    # Members named e.g. ../x or /x would be written outside of the directory
+    member_path = base_dir.joinpath(filename).resolve()
+    try:
+        member_path.relative_to(base_dir.resolve())
+    except ValueError:
+        raise Exception(f"{filename} is outside of the archive.") from None
+    return member_path
+
+
+def decodeZipFilename(info: ZipInfo) -> str:
+    if (info.flag_bits & ZIP_FILENAME_UTF8_FLAG) == 0:
+        # Redecode as cp932 (Shift-JIS)
+        return info.filename.encode('cp437').decode('cp932')
+    return info.filename
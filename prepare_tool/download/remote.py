@@ -0,0 +1,153 @@
+import io
+import re
+import bisect
+import requests
+from typing import Dict, Iterable, List, Optional
+from urllib3.exceptions import HTTPError
+
+# Bytes read from the end of a file by the first request.
+# Central directories of most archives fit in it, so they need no request of their own.
+TAIL_SIZE = 1024 * 1024
+CONTENT_RANGE_PATTERN = re.compile(r'bytes (\d+)-(\d+)/(\d+)')
+WEAK_ETAG_PREFIX = 'W/'
+
+
+class RemoteFileChanged(Exception):
+    '''
+    Raised when a file is replaced on the server while it is read with range requests.
+    '''
+
+
+class RemoteFile(io.RawIOBase):
+    '''
+    Read-only seekable file over HTTP range requests.
+    Sequential reads continue one streamed response, which ends at the next boundary, e.g. the next zip member.
+    '''
+    def __init__(
+        self,
+        session: requests.Session,
+        url: str,
+        headers: Dict[str, str],
+        size: int,
+        tail: bytes,
+        etag: Optional[str] = None,
+    ) -> None:
+        super().__init__()
+        self.__session = session
+        self.__url = url
+        self.__headers = headers
+        self.__size = size
+        self.__etag = etag
+        self.__tail = tail
+        self.__tail_offset = size - len(tail)
+        self.__boundaries: List[int] = [self.__tail_offset]
+        self.__pos = 0
+        self.__response: Optional[requests.Response] = None
+        self.__response_pos = 0
+        self.__response_end = 0
+
+    @classmethod
+    def open(cls, session: requests.Session, url: str, referer: str) -> Optional['RemoteFile']:
+        '''
+        Read the end of a file, or return None when the server does not support range requests.
+        '''
+        headers = {'Referer': referer, 'Accept-Encoding': 'identity'}
+        with session.get(url, headers={**headers, 'Range': f"bytes=-{TAIL_SIZE}"}, stream=True) as res:
+            res.raise_for_status()
+            matched = CONTENT_RANGE_PATTERN.fullmatch(res.headers.get('content-range', ''))
+            if res.status_code != 206 or matched is None:
+                return None
+            tail = res.content
+
+        # Later ranges must come from the same file, otherwise the server answers with the whole new file.
+        # Weak ETags are not allowed in If-Range, servers would always answer with the whole file.
+        etag = res.headers.get('etag')
+        if etag and not etag.startswith(WEAK_ETAG_PREFIX):
+            headers['If-Range'] = etag
+        elif res.headers.get('last-modified'):
+            headers['If-Range'] = res.headers['last-modified']
+        return cls(session, res.url, headers, int(matched.group(3)), tail, etag)
+
+    @property
+    def size(self) -> int:
+        return self.__size
+
+    def addBoundaries(self, offsets: Iterable[int]) -> None:
+        self.__boundaries = sorted({*self.__boundaries, *offsets})
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.__pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.__pos
+        elif whence == io.SEEK_END:
+            offset += self.__size
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self.__pos = offset
+        return self.__pos
+
+    def readinto(self, buffer) -> int:
+        view = memoryview(buffer).cast('B')
+        filled = 0
+        while filled < len(view) and self.__pos < self.__size:
+            if self.__pos >= self.__tail_offset:
+                chunk = self.__tail[self.__pos - self.__tail_offset:][:len(view) - filled]
+            else:
+                chunk = self.__readStream(len(view) - filled)
+            view[filled:filled + len(chunk)] = chunk
+            filled += len(chunk)
+            self.__pos += len(chunk)
+        return filled
+
+    def close(self) -> None:
+        self.__closeStream()
+        super().close()
+
+    def __readStream(self, size: int) -> bytes:
+        if self.__response is None or self.__response_pos != self.__pos or self.__pos >= self.__response_end:
+            self.__openStream()
+
+        try:
+            chunk = self.__response.raw.read(size)
+        except HTTPError as error:
+            raise requests.exceptions.ConnectionError(error) from error
+        if len(chunk) == 0:
+            raise requests.exceptions.ConnectionError(f"Response of {self.__url} ended at {self.__pos}.")
+        self.__response_pos += len(chunk)
+        return chunk
+
+    def __openStream(self) -> None:
+        self.__closeStream()
+        end = self.__boundaries[bisect.bisect_right(self.__boundaries, self.__pos)]
+
+        res = self.__session.get(
+            self.__url, headers={
+                **self.__headers, 'Range': f"bytes={self.__pos}-{end - 1}"
+            }, stream=True
+        )
+        matched = CONTENT_RANGE_PATTERN.fullmatch(res.headers.get('content-range', ''))
+        etag = res.headers.get('etag')
+        if (
+            res.status_code != 206 or matched is None or int(matched.group(1)) != self.__pos or
+            int(matched.group(3)) != self.__size or (self.__etag is not None and etag not in (None, self.__etag))
+        ):
+            res.close()
+            res.raise_for_status()
+            raise RemoteFileChanged(f"{self.__url} has changed while it was read.")
+
+        self.__response = res
+        self.__response_pos = self.__pos
+        self.__response_end = end
+
+    def __closeStream(self) -> None:
+        if self.__response is not None:
+            self.__response.close()
+            self.__response = None
@@ -0,0 +1,80 @@
+import hashlib
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Tuple
+
+# fontTools is imported on first use, commands which never open a font start without it.
+if TYPE_CHECKING:
+    from fontTools.ttLib import TTCollection, TTFont
+
+TTC_TAG = b'ttcf'
+
+
+class FontFileCache():
+    '''
+    Fonts parsed lazily once and shared by generators.
+    All faces of a collection come from one TTCollection, so tables shared between the faces are decompiled once.
+    '''
+    def __init__(self, instance_dir: Path) -> None:
+        self.__instance_dir = instance_dir
+        self.__collections: Dict[Path, 'TTCollection'] = {}
+        self.__fonts: Dict[Path, 'TTFont'] = {}
+        self.__variable_fonts: Dict[Tuple[Path, int], 'TTFont'] = {}
+        self.__instances: Dict[Tuple[Path, int, Tuple], Path] = {}
+
+    def open(self, font_path: Path, font_number: int = 0) -> 'TTFont':
+        from fontTools.ttLib import TTCollection, TTFont
+
+        if font_path in self.__collections:
+            return self.__collections[font_path][font_number]
+        if font_path in self.__fonts:
+            return self.__fonts[font_path]
+
+        with open(font_path, 'rb') as font_read_io:
+            is_collection = font_read_io.read(4) == TTC_TAG
+
+        if is_collection:
+            self.__collections[font_path] = TTCollection(file=str(font_path), lazy=True, shareTables=True)
+            return self.__collections[font_path][font_number]
+
+        self.__fonts[font_path] = TTFont(file=str(font_path), lazy=True)
+        return self.__fonts[font_path]
+
+    def instantiate(self, font_path: Path, font_number: int, variations: Dict[str, float]) -> Path:
+        '''
+        Write a static instance of a variable font at the given axis coordinates and return its path.
+        The variable font is parsed only once for all instances.
+        '''
+        from fontTools.ttLib import TTFont
+        from fontTools.varLib import instancer
+
+        key = (font_path, font_number, tuple(sorted(variations.items())))
+        if key in self.__instances:
+            return self.__instances[key]
+
+        if (font_path, font_number) not in self.__variable_fonts:
+            variable_font = TTFont(file=str(font_path), fontNumber=font_number)
+            if 'fvar' not in variable_font:
+                raise Exception(f"{font_path.name} is not a variable font.")
+            self.__variable_fonts[(font_path, font_number)] = variable_font
+
+        variable_font = self.__variable_fonts[(font_path, font_number)]
+        instance = instancer.instantiateVariableFont(variable_font, variations, inplace=False)
+
+        digest = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()[:16]
+        suffix = '.otf' if 'CFF ' in instance or 'CFF2' in instance else '.ttf'
+        instance_path = self.__instance_dir.joinpath(f"./{font_path.stem}-{digest}{suffix}")
+        self.__instance_dir.mkdir(parents=True, exist_ok=True)
+        instance.save(str(instance_path))
+        instance.close()
+
+        self.__instances[key] = instance_path
+        return instance_path
+
+    def close(self) -> None:
+        for ttfont in [*self.__fonts.values(), *self.__variable_fonts.values()]:
+            ttfont.close()
+        for collection in self.__collections.values():
+            collection.close()
+        self.__fonts.clear()
+        self.__variable_fonts.clear()
+        self.__collections.clear()
@@ -0,0 +1,176 @@
+import json
+import zlib
+import sqlite3
+import struct
+from dataclasses import asdict, dataclass
+from itertools import accumulate
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from prepare_tool.fonts import FontFileCache
+
+if TYPE_CHECKING:
+    from fontTools.ttLib import TTFont
+
+METADATA_VERSION = 3
+METADATA_DB_FILENAME = 'fonts.sqlite3'
+# Name records are read from Windows, Unicode BMP, English (US)
+NAME_RECORD_KEY = (3, 1, 0x409)
+
+
+@dataclass()
+class NamedInstance():
+    '''
+    Named instance of a variable font, e.g. Bold at wght=700.
+    '''
+    coordinates: Dict[str, float]
+    subfamily_name_id: int
+    postscript_name_id: Optional[int]
+
+
+@dataclass()
+class FontMetadata():
+    '''
+    Parts of a font needed outside of subsetting, so the font itself is not parsed again.
+    '''
+    names: Dict[int, str]
+    codepoints: FrozenSet[int]
+    glyph_count: int
+    tables: List[str]
+    instances: List[NamedInstance]
+
+    def getName(self, name_id: int) -> Optional[str]:
+        return self.names.get(name_id)
+
+    def findInstance(self, variations: Dict[str, float]) -> Optional[NamedInstance]:
+        for instance in self.instances:
+            if instance.coordinates == variations:
+                return instance
+        return None
+
+    @classmethod
+    def extract(cls, ttfont: 'TTFont') -> 'FontMetadata':
+        names: Dict[int, str] = {}
+        for record in ttfont['name'].names:
+            if (record.platformID, record.platEncID, record.langID) == NAME_RECORD_KEY:
+                names.setdefault(record.nameID, record.toUnicode())
+        instances: List[NamedInstance] = []
+        if 'fvar' in ttfont:
+            for instance in ttfont['fvar'].instances:
+                instances.append(
+                    NamedInstance(
+                        coordinates=dict(instance.coordinates),
+                        subfamily_name_id=instance.subfamilyNameID,
+                        # 0xFFFF when the instance has no PostScript name
+                        postscript_name_id=instance.postscriptNameID if instance.postscriptNameID != 0xFFFF else None,
+                    )
+                )
+        return cls(
+            names=names,
+            codepoints=frozenset((ttfont.getBestCmap() or {}).keys()),
+            glyph_count=ttfont['maxp'].numGlyphs,
+            tables=sorted(ttfont.reader.keys()),
+            instances=instances,
+        )
+
+
+class FontMetadataCache():
+    '''
+    Metadata of fonts keyed by SHA256 and font number.
+    With cache_dir, metadata is kept in a SQLite database across runs.
+    '''
+    def __init__(self, fonts: FontFileCache, cache_dir: Optional[Path] = None) -> None:
+        self.__fonts = fonts
+        self.__cache_dir = cache_dir
+        self.__connection: Optional[sqlite3.Connection] = None
+        self.__metadata: Dict[Tuple[str, int], FontMetadata] = {}
+
+    def get(self, font_path: Path, sha256: str, font_number: int = 0) -> FontMetadata:
+        key = (sha256, font_number)
+        if key not in self.__metadata:
+            metadata = self.__load(key)
+            if metadata is None:
+                metadata = FontMetadata.extract(self.__fonts.open(font_path, font_number))
+                self.__store(key, metadata)
+            self.__metadata[key] = metadata
+        return self.__metadata[key]
+
+    def close(self) -> None:
+        if self.__connection is not None:
+            self.__connection.close()
+            self.__connection = None
+        self.__metadata.clear()
+
+    def __connect(self) -> Optional[sqlite3.Connection]:
+        if self.__cache_dir is None:
+            return None
+        if self.__connection is None:
+            self.__cache_dir.mkdir(parents=True, exist_ok=True)
+            self.__connection = sqlite3.connect(str(self.__cache_dir.joinpath(METADATA_DB_FILENAME)), timeout=30)
+            with self.__connection:
+                (version, ) = self.__connection.execute('PRAGMA user_version').fetchone()
+                if version != METADATA_VERSION:
+                    # Rows written by another version have different columns or encodings
+                    self.__connection.execute('DROP TABLE IF EXISTS fonts')
+                    self.__connection.execute(f"PRAGMA user_version = {METADATA_VERSION}")
+                self.__connection.execute(
+                    'CREATE TABLE IF NOT EXISTS fonts ('
+                    'sha256 TEXT NOT NULL, number INTEGER NOT NULL, names TEXT NOT NULL, '
+                    'codepoints BLOB NOT NULL, glyph_count INTEGER NOT NULL, tables TEXT NOT NULL, '
+                    'instances TEXT NOT NULL, PRIMARY KEY (sha256, number))'
+                )
+        return self.__connection
+
+    def __load(self, key: Tuple[str, int]) -> Optional[FontMetadata]:
+        connection = self.__connect()
+        if connection is None:
+            return None
+
+        row = connection.execute(
+            'SELECT names, codepoints, glyph_count, tables, instances FROM fonts WHERE sha256 = ? AND number = ?',
+            key,
+        ).fetchone()
+        if row is None:
+            return None
+        names, codepoints, glyph_count, tables, instances = row
+        return FontMetadata(
+            names={
+                int(name_id): name
+                for name_id, name in json.loads(names).items()
+            },
+            codepoints=unpackCodepoints(codepoints),
+            glyph_count=glyph_count,
+            tables=json.loads(tables),
+            instances=[NamedInstance(**instance) for instance in json.loads(instances)],
+        )
+
+    def __store(self, key: Tuple[str, int], metadata: FontMetadata) -> None:
+        connection = self.__connect()
+        if connection is None:
+            return
+
+        with connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO fonts VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (
+                    *key,
+                    json.dumps(metadata.names, ensure_ascii=False),
+                    packCodepoints(metadata.codepoints),
+                    metadata.glyph_count,
+                    json.dumps(metadata.tables),
+                    json.dumps([asdict(instance) for instance in metadata.instances]),
+                ),
+            )
+
+
+def packCodepoints(codepoints: Iterable[int]) -> bytes:
+    # Sorted codepoints are stored as deltas, which are mostly 1 and compress well
+    # Packed as little-endian 32-bit integers, so the cache does not depend on the size of C long
+    sorted_codepoints = sorted(codepoints)
+    deltas = [b - a for a, b in zip([0, *sorted_codepoints], sorted_codepoints)]
+    return zlib.compress(struct.pack(f"<{len(deltas)}I", *deltas))
+
+
+def unpackCodepoints(data: bytes) -> FrozenSet[int]:
+    data = zlib.decompress(data)
+    return frozenset(accumulate(struct.unpack(f"<{len(data) // 4}I", data)))
@@ -0,0 +1,107 @@
+import yaml
+import hashlib
+from dataclasses import dataclass
+from typing import Any, Dict, List
+from xml.etree.ElementTree import Element, tostring as to_xml_string
+from faker import Faker
+from fontTools import version as fonttools_version
+from fontTools.subset import Options
+
+from prepare_tool.cache import OutputCache
+from prepare_tool.const import DEFAULT_COMPRESSION_PROFILE, FILE_DIR
+from prepare_tool.models import Font, Package
+
+
+@dataclass()
+class SubsetSettings():
+    '''
+    Everything subsets of a font are generated with, apart from their unicodes.
+    The output cache key and the build plan are both hashed by createKey, so they can not drift apart.
+    '''
+    options: Options
+    subset_fontname: str
+    metadata: bytes
+
+    @classmethod
+    def create(cls, package: Package, font: Font) -> 'SubsetSettings':
+        fake = Faker()
+        fake.seed(package.id)
+
+        options = Options()
+        # Subsets of a variable font are cut from a static instance, which is a single font
+        options.font_number = font.number if font.variations is None else 0
+        options.hinting = False
+        options.desubroutinize = True
+        options.drop_tables += [
+            'FFTM', 'PfEd', 'TeX', 'BDF', 'cvt', 'fpgm', 'prep', 'gasp', 'VORG', 'CBDT', 'CBLC', 'sbix'
+        ]
+        for ignored in ['rvrn', 'locl']:
+            options.layout_features.remove(ignored)
+
+        return cls(options=options, subset_fontname=fake.name(), metadata=generateMetadata(package))
+
+    def createKey(
+        self,
+        package: Package,
+        font: Font,
+        unicodes: Any,
+        compression_profile: str = DEFAULT_COMPRESSION_PROFILE,
+        **inputs: Any,
+    ) -> str:
+        variations = {} if font.variations is None else {'variations': font.variations}
+        return OutputCache.createKey(
+            font_sha256=font.sha256,
+            font_number=font.number,
+            **variations,
+            **compressionInputs(compression_profile),
+            unicodes=unicodes,
+            options=vars(self.options),
+            subset_fontname=self.subset_fontname,
+            copyrights=package.copyrights,
+            metadata=hashlib.sha256(self.metadata).hexdigest(),
+            fonttools_version=fonttools_version,
+            **inputs,
+        )
+
+
+def compressionInputs(compression_profile: str) -> Dict[str, str]:
+    if compression_profile == DEFAULT_COMPRESSION_PROFILE:
+        return {}
+    return {'compression_profile': compression_profile}
+
+
+def generateMetadata(package: Package) -> bytes:
+    yaml_path = FILE_DIR.METADATA_TEMPLATE.joinpath(f"./{package.license}.yml")
+    if not yaml_path.exists():
+        raise Exception(f"{package.license} is invalid license id.")
+
+    with open(yaml_path, 'r', encoding='utf-8') as yaml_read_io:
+        data = yaml.safe_load(yaml_read_io.read())
+
+    root_el = generateXMLElement(data['metadata'], 'metadata')
+    copyright_el = generateXMLElement({}, 'copyright')
+    for copyright_text in package.copyrights:
+        copyright_el.append(generateXMLElement({'_text': copyright_text}, 'text'))
+    root_el.append(copyright_el)
+
+    xml = to_xml_string(root_el, encoding='unicode')
+    return f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>{xml}'.encode('utf-8')
+
+
+def generateXMLElement(props: dict, tagname: str) -> Element:
+    el = Element(tagname)
+    if '_text' in props:
+        el.text = props['_text']
+    if '_attributes' in props:
+        el.attrib = props['_attributes']
+    for child_tagname, child_props_or_list in props.items():
+        if child_tagname.startswith('_'):
+            continue
+        if not isinstance(child_props_or_list, list):
+            child_props_list: List[dict] = [child_props_or_list]
+        else:
+            child_props_list = child_props_or_list
+        for child_props in child_props_list:
+            child_el = generateXMLElement(child_props, child_tagname)
+            el.append(child_el)
+    return el
@@ -1,32 +1,67 @@
+import zlib
+import struct
 import pystache
-import gzip
-from tempfile import TemporaryDirectory
-from pathlib import Path
-from shutil import copyfile
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
 from io import BytesIO
-from tarfile import TarFile
+from tarfile import TarFile, TarInfo
+from tempfile import NamedTemporaryFile
+from pathlib import Path
+from typing import BinaryIO, Deque, List, Optional
 
 from prepare_tool.core import Core
-from prepare_tool.const import FILE_DIR
+from prepare_tool.cache import moveIntoPlace
+from prepare_tool.const import FILE_DIR, ARCHIVE_EXTENSION
+
+GZIP_COMPRESS_LEVEL = 9
+XZ_PRESET = 9
+PARALLEL_GZIP_BLOCK_SIZE = 1024 * 1024
+DEFLATE_WINDOW_SIZE = 32 * 1024
 
 
 class ArchiveGenerator():
-    def __init__(self, core: Core) -> None:
+    def __init__(self, core: Core, archive_format: str = 'gz', threads: int = 1) -> None:
         self.__core = core
+        self.__archive_format = archive_format
+        self.__threads = threads
 
     def generate(self) -> None:
         package = self.__core.package
         output_dir = self.__core.directories.archives
 
-        with TemporaryDirectory() as tmp_dir_pathstr:
-            tmp_dir = Path(tmp_dir_pathstr)
-            archive_file = output_dir.joinpath(f"./{package.id}.tar.gz")
+        extension = ARCHIVE_EXTENSION.get(self.__archive_format)
+        if extension is None:
+            raise Exception(f"{self.__archive_format} is unsupported archive format.")
+        archive_file = output_dir.joinpath(f"./{package.id}.{extension}")
 
-            self.__generateLicenseFile(tmp_dir)
-            self.__copyFontfile(tmp_dir)
-            self.__archive(target_path=tmp_dir, output_path=archive_file)
+        # Written next to the archive and moved on success, so a failed run keeps the last good archive.
+        with NamedTemporaryFile(dir=output_dir, prefix=f".{package.id}.", delete=False) as tmp_file:
+            tmp_path = Path(tmp_file.name)
+        try:
+            with ExitStack() as stack:
+                archive_io = stack.enter_context(open(tmp_path, 'wb'))
+                compressed_io = stack.enter_context(self.__openCompressor(archive_io))
+                archive = stack.enter_context(TarFile.open(mode='w|', fileobj=compressed_io))
 
-    def __generateLicenseFile(self, dest_dir: Path) -> None:
+                self.__addLicenseFile(archive)
+                self.__addFontfiles(archive)
+        except BaseException:
+            tmp_path.unlink()
+            raise
+        moveIntoPlace(tmp_path, archive_file)
+
+    def __openCompressor(self, archive_io: BinaryIO):
+        if self.__archive_format == 'gz':
+            if self.__threads > 1:
+                return ParallelGzipWriter(archive_io, threads=self.__threads)
+            return GzipWriter(archive_io)
+        elif self.__archive_format == 'xz':
+            import lzma
+            return lzma.LZMAFile(archive_io, mode='wb', preset=XZ_PRESET)
+        raise Exception(f"{self.__archive_format} is unsupported archive format.")
+
+    def __addLicenseFile(self, archive: TarFile) -> None:
         package = self.__core.package
 
         template_path = FILE_DIR.LICENSE_TEMPLATE.joinpath(f"./{package.license}.txt")
@@ -35,23 +70,124 @@ class ArchiveGenerator():
 
         with open(template_path, 'r', encoding='utf-8') as read_io:
             license_text: str = pystache.render(read_io.read(), package)
-        with open(dest_dir.joinpath('LICENSE'), 'w', encoding='utf-8') as write_io:
-            write_io.write(license_text)
 
-    def __copyFontfile(self, dest_dir: Path) -> None:
+        license_data = license_text.encode('utf-8')
+        info = TarInfo('LICENSE')
+        info.size = len(license_data)
+        info.mode = 0o644
+        info.mtime = int(template_path.stat().st_mtime)
+        archive.addfile(info, BytesIO(license_data))
+
+    def __addFontfiles(self, archive: TarFile) -> None:
         package = self.__core.package
 
+        font_paths: List[Path] = []
         for source in package.sources:
             for weight, font in source.fonts:
                 if font is None:
                     continue
-                font_path = self.__core.findFontfilePath(font)
-                copyfile(font_path, dest_dir.joinpath(font_path.name))
+                font_paths.append(self.__core.findFontfilePath(font))
+
+        # Weights from the same TTC or variable font share one file
+        for font_path in dict.fromkeys(font_paths):
+            # Fonts are streamed from the extracted tree without intermediate copies.
+            archive.add(str(font_path), arcname=font_path.name, recursive=False)
+
+
+class GzipWriter():
+    '''
+    Single-threaded gzip stream with the same layout as ParallelGzipWriter.
+    '''
+    def __init__(self, fileobj: BinaryIO) -> None:
+        self.__fileobj = fileobj
+        self.__compressor = zlib.compressobj(GZIP_COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.__crc = 0
+        self.__size = 0
+        self.__fileobj.write(gzipHeader())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def write(self, data: bytes) -> int:
+        self.__crc = zlib.crc32(data, self.__crc)
+        self.__size += len(data)
+        self.__fileobj.write(self.__compressor.compress(data))
+        return len(data)
+
+    def close(self) -> None:
+        if self.__compressor is None:
+            return
+        self.__fileobj.write(self.__compressor.flush(zlib.Z_FINISH))
+        self.__fileobj.write(struct.pack('<II', self.__crc, self.__size & 0xFFFFFFFF))
+        self.__compressor = None
+
+
+class ParallelGzipWriter():
+    '''
+    pigz-style gzip stream. Blocks are deflated concurrently and concatenated into one standard gzip member.
+    Each block is primed with the last 32KiB of the previous block, so the ratio stays close to plain gzip.
+    '''
+    def __init__(self, fileobj: BinaryIO, threads: int, block_size: int = PARALLEL_GZIP_BLOCK_SIZE) -> None:
+        self.__fileobj = fileobj
+        self.__threads = threads
+        self.__block_size = block_size
+        self.__executor: Optional[ThreadPoolExecutor] = ThreadPoolExecutor(max_workers=threads)
+        self.__pending: Deque[Future] = deque()
+        self.__buffer = bytearray()
+        self.__dictionary = b''
+        self.__crc = 0
+        self.__size = 0
+        self.__fileobj.write(gzipHeader())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def write(self, data: bytes) -> int:
+        self.__crc = zlib.crc32(data, self.__crc)
+        self.__size += len(data)
+        self.__buffer += data
+
+        # The last block is kept until close(), since only it may carry the final deflate block.
+        while len(self.__buffer) > self.__block_size:
+            block = bytes(self.__buffer[:self.__block_size])
+            del self.__buffer[:self.__block_size]
+            self.__submit(block, last=False)
+        return len(data)
+
+    def close(self) -> None:
+        if self.__executor is None:
+            return
+        self.__submit(bytes(self.__buffer), last=True)
+        self.__buffer = bytearray()
+        while len(self.__pending) != 0:
+            self.__fileobj.write(self.__pending.popleft().result())
+        self.__fileobj.write(struct.pack('<II', self.__crc, self.__size & 0xFFFFFFFF))
+        self.__executor.shutdown()
+        self.__executor = None
+
+    def __submit(self, block: bytes, last: bool) -> None:
+        self.__pending.append(self.__executor.submit(deflateBlock, block, self.__dictionary, last))
+        self.__dictionary = block[-DEFLATE_WINDOW_SIZE:]
+
+        # Bound memory by writing out finished blocks in order.
+        while len(self.__pending) > self.__threads * 2 or (len(self.__pending) != 0 and self.__pending[0].done()):
+            self.__fileobj.write(self.__pending.popleft().result())
+
+
+def gzipHeader() -> bytes:
+    # magic, deflate, no flags, mtime 0, max compression, unknown OS
+    return struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0, 0, 2, 255)
 
-    def __archive(self, target_path: Path, output_path: Path) -> None:
-        with BytesIO() as stream, TarFile.open(mode='w', fileobj=stream) as archive:
-            for file_path in target_path.glob('*'):
-                archive.add(str(file_path), arcname=file_path.name, recursive=False)
 
-            with open(output_path, 'wb') as archive_io:
-                archive_io.write(gzip.compress(stream.getvalue()))
+def deflateBlock(block: bytes, dictionary: bytes, last: bool) -> bytes:
+    if dictionary:
+        compressor = zlib.compressobj(GZIP_COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(GZIP_COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
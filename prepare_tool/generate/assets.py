@@ -0,0 +1,134 @@
+import json
+import brotli
+import shutil
+import hashlib
+from gzip import GzipFile
+from io import BytesIO
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+from prepare_tool.core import Core
+from prepare_tool.cache import linkOrCopy
+from prepare_tool.plan import hashFile
+
+DEPLOY_MANIFEST_VERSION = 1
+DEPLOY_MANIFEST_FILENAME = 'deploy.json'
+ASSET_DIR_NAME = 'assets'
+# Hex digits of SHA256 in names of assets
+ASSET_HASH_LENGTH = 16
+SUBSET_SUFFIXES = ['.woff2', '.woff']
+PRECOMPRESSED_ENCODINGS = {'.br': 'br', '.gz': 'gzip'}
+
+
+class AssetManifest():
+    '''
+    Names subsets by the hash of their contents, so they can be served as immutable,
+    and lists every file of the package with its size and hash for uploaders.
+    '''
+    def __init__(self, core: Core) -> None:
+        self.__core = core
+        self.__base_dir = core.directories.webfonts
+        self.__asset_dir = self.__base_dir.joinpath(f"./{ASSET_DIR_NAME}")
+        self.__subsets: List[dict] = []
+        self.__stylesheets: List[dict] = []
+
+    def addSubset(self, weight: str, group: str) -> str:
+        '''
+        Link WOFF2 and WOFF of a subset under the hash of both, and return their path without suffix.
+        WOFF2 and WOFF share the name, as stylesheets refer to both from one base path.
+        '''
+        subset_dir = self.__base_dir.joinpath(f"./{self.__core.package.version}/{weight}")
+        subset_paths = [subset_dir.joinpath(f"./{group}{suffix}") for suffix in SUBSET_SUFFIXES]
+        file_hashes: List[str] = []
+        for subset_path in subset_paths:
+            file_hash = hashFile(subset_path)
+            if file_hash is None:
+                raise Exception(f"{subset_path} is not found, webfonts are needed to name them by hash.")
+            file_hashes.append(file_hash)
+        asset_name = hashlib.sha256(''.join(file_hashes).encode('utf-8')).hexdigest()[:ASSET_HASH_LENGTH]
+
+        self.__asset_dir.mkdir(parents=True, exist_ok=True)
+        for suffix, subset_path, file_hash in zip(SUBSET_SUFFIXES, subset_paths, file_hashes):
+            asset_path = self.__asset_dir.joinpath(f"./{asset_name}{suffix}")
+            # Assets are immutable, an existing one already has the same contents
+            if not asset_path.is_file():
+                linkOrCopy(subset_path, asset_path)
+            self.__subsets.append(
+                {
+                    'weight': weight,
+                    'group': group,
+                    'format': suffix[1:],
+                    'path': f"{ASSET_DIR_NAME}/{asset_name}{suffix}",
+                    'size': asset_path.stat().st_size,
+                    'sha256': file_hash,
+                }
+            )
+        return f"./{ASSET_DIR_NAME}/{asset_name}"
+
+    def addStyleSheet(self, style_path: Path, weight: Optional[str] = None) -> None:
+        '''
+        List a stylesheet and write its precompressed variants next to it.
+        '''
+        with open(style_path, 'rb') as style_read_io:
+            data = style_read_io.read()
+
+        variants = [(style_path, None, data)]
+        for suffix, encoding in PRECOMPRESSED_ENCODINGS.items():
+            compressed = precompress(data, encoding)
+            variant_path = style_path.with_name(f"{style_path.name}{suffix}")
+            with open(variant_path, 'wb') as variant_write_io:
+                variant_write_io.write(compressed)
+            variants.append((variant_path, encoding, compressed))
+
+        for variant_path, encoding, variant_data in variants:
+            self.__stylesheets.append(
+                {
+                    'weight': weight,
+                    'encoding': encoding,
+                    'path': variant_path.relative_to(self.__base_dir).as_posix(),
+                    'size': len(variant_data),
+                    'sha256': hashlib.sha256(variant_data).hexdigest(),
+                }
+            )
+
+    def write(self) -> None:
+        # Assets and precompressed stylesheets which are no longer listed are removed, so they are not uploaded
+        listed = {self.__base_dir.joinpath(entry['path']) for entry in [*self.__subsets, *self.__stylesheets]}
+        for stale_path in [*self.__asset_dir.glob('*'), *iterPrecompressedStyleSheets(self.__base_dir)]:
+            if stale_path not in listed:
+                stale_path.unlink()
+
+        with open(self.__base_dir.joinpath(f"./{DEPLOY_MANIFEST_FILENAME}"), 'w', encoding='utf-8') as manifest_io:
+            data = {
+                'version': DEPLOY_MANIFEST_VERSION,
+                'id': self.__core.package.id,
+                'subsets': self.__subsets,
+                'stylesheets': self.__stylesheets,
+            }
+            manifest_io.write(json.dumps(data, indent=2, sort_keys=True))
+
+
+def removeAssets(base_dir: Path) -> None:
+    # Left from a build with hashed assets, precompressed stylesheets would be served instead of the new ones.
+    for variant_path in iterPrecompressedStyleSheets(base_dir):
+        variant_path.unlink()
+    if base_dir.joinpath(f"./{DEPLOY_MANIFEST_FILENAME}").is_file():
+        base_dir.joinpath(f"./{DEPLOY_MANIFEST_FILENAME}").unlink()
+    if base_dir.joinpath(f"./{ASSET_DIR_NAME}").is_dir():
+        shutil.rmtree(base_dir.joinpath(f"./{ASSET_DIR_NAME}"))
+
+
+def iterPrecompressedStyleSheets(base_dir: Path) -> Iterator[Path]:
+    for suffix in PRECOMPRESSED_ENCODINGS.keys():
+        yield from base_dir.glob(f"style*.css{suffix}")
+
+
+def precompress(data: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(data, mode=brotli.MODE_TEXT, quality=11)
+
+    # Without mtime and filename, the same stylesheet always compresses to the same bytes
+    compressed_io = BytesIO()
+    with GzipFile(filename='', mode='wb', compresslevel=9, fileobj=compressed_io, mtime=0) as gzip_io:
+        gzip_io.write(data)
+    return compressed_io.getvalue()
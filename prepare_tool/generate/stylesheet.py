@@ -1,21 +1,58 @@
 import pystache
-from typing import Set, List
-from fontTools.ttLib import TTFont
+from contextlib import ExitStack
+from functools import lru_cache
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Set, List, Optional, TextIO, Tuple
 from css_html_js_minify import css_minify
 
 from prepare_tool.core import Core
+from prepare_tool.cache import moveIntoPlace
 from prepare_tool.models import Font
+from prepare_tool.fonts.metadata import FontMetadata
 from prepare_tool.const import NAME_ID, FILE_DIR, WEIGHT_NUMBER
+from prepare_tool.unicodes import UnicodeGroupIndex
+from prepare_tool.unicodes.adaptive import getCoveredUnicodeGroups, getFontUnicodeGroups
+from prepare_tool.report import Measurement, measurePhase
+from prepare_tool.generate.assets import AssetManifest, removeAssets
 
-with open(FILE_DIR.STYLESHEETS_TEMPLATE.joinpath('./base.css'), 'r', encoding='utf-8') as base_template_read_io:
-    BASE_TEMPLATE = pystache.parse(base_template_read_io.read())
-with open(FILE_DIR.STYLESHEETS_TEMPLATE.joinpath('./local.css'), 'r', encoding='utf-8') as local_template_read_io:
-    LOCAL_TEMPLATE = pystache.parse(local_template_read_io.read())
+# Placeholders kept as is by css_minify, filled after a rule template is minified
+CSS_PLACEHOLDER = '__CSS__'
+FONT_BASE_PATH_PLACEHOLDER = '__FONT_BASE_PATH__'
+UNICODES_PLACEHOLDER = '__UNICODES__'
+CHARSET_RULE = '@charset "utf-8";'
+
+
+@lru_cache(maxsize=None)
+def loadTemplate(name: str) -> pystache.parsed.ParsedTemplate:
+    # Templates are parsed on first use instead of at import time
+    with open(FILE_DIR.STYLESHEETS_TEMPLATE.joinpath(f"./{name}.css"), 'r', encoding='utf-8') as template_read_io:
+        return pystache.parse(template_read_io.read())
+
+
+def minifyRule(name: str, context: dict) -> str:
+    return css_minify(pystache.render(loadTemplate(name), context), noprefix=True)
 
 
 class StyleSheetGenerator():
-    def __init__(self, core: Core) -> None:
+    '''
+    Writes minified @font-face rules directly to the stylesheets.
+    Each rule template is minified once per weight, rules of unicode groups only fill in the placeholders.
+    '''
+    def __init__(
+        self,
+        core: Core,
+        measurement: Optional[Measurement] = None,
+        group_budget: Optional[int] = None,
+        split_css: bool = False,
+        hashed_assets: bool = False,
+    ) -> None:
         self.__core = core
+        self.__group_budget = group_budget
+        self.__split_css = split_css
+        self.__hashed_assets = hashed_assets
+        self.__assets: Optional[AssetManifest] = None
+        self.__measurement = measurement or Measurement(stage='stylesheet')
 
     def generate(self) -> None:
         package = self.__core.package
@@ -24,74 +61,146 @@ class StyleSheetGenerator():
         license_template_path = FILE_DIR.STYLESHEETS_TEMPLATE.joinpath(f"./{package.license}.css")
         if not license_template_path.exists():
             raise Exception(f"{package.license} is invalid license id.")
-        with open(license_template_path, 'r', encoding='utf-8') as license_template_read_io:
-            license_template = pystache.parse(license_template_read_io.read())
-
-        generated_style = ''
-        for source in package.sources:
-            for weight, font in source.fonts:
-                if font is None:
-                    continue
-                generated_style += self.__generateStyleForWeight(weight=weight, font=font)
-
-        with open(output_dir.joinpath('./style.min.css'), 'wb') as style_io:
-            minified = pystache.render(license_template, {'css': css_minify(generated_style)})
-            style_io.write(minified.encode('utf-8'))
-
-    def __generateStyleForWeight(self, weight: str, font: Font) -> str:
-        style = ''
-        package = self.__core.package
-        weight_number = getattr(WEIGHT_NUMBER, weight)
-        local_name_list = self.__getLocalFamilyName(font)
-
-        style += pystache.render(
-            LOCAL_TEMPLATE,
-            {
-                'package': package,
-                'weight_number': weight_number,
-                'local_src': ','.join(map(lambda n: f"local('{n}')", local_name_list)),
-            },
+        license_style = pystache.render(loadTemplate(package.license.value), {'css': CSS_PLACEHOLDER})
+        header, footer = license_style.split(CSS_PLACEHOLDER)
+
+        self.__assets = AssetManifest(self.__core) if self.__hashed_assets else None
+        # Stylesheets written, with the weight they are split for
+        outputs: List[Tuple[Path, Optional[str]]] = [(output_dir.joinpath('./style.min.css'), None)]
+        # Rendered into temporary files, which replace the stylesheets only after every weight succeeded
+        tmp_paths: List[Path] = []
+        try:
+            with ExitStack() as stack:
+                style_io = stack.enter_context(self.__openTemporary(output_dir, tmp_paths))
+                style_io.write(header + CHARSET_RULE)
+                for source in package.sources:
+                    for weight, font in source.fonts:
+                        if font is None:
+                            continue
+                        if not self.__split_css:
+                            self.__writeStyleForWeight(weight, font, [style_io])
+                            continue
+
+                        outputs.append((output_dir.joinpath(f"./style.{weight}.min.css"), weight))
+                        with self.__openTemporary(output_dir, tmp_paths) as weight_style_io:
+                            weight_style_io.write(header + CHARSET_RULE)
+                            self.__writeStyleForWeight(weight, font, [style_io, weight_style_io])
+                            weight_style_io.write(footer)
+                style_io.write(footer)
+        except BaseException:
+            for tmp_path in tmp_paths:
+                tmp_path.unlink()
+            raise
+
+        for (output_path, _), tmp_path in zip(outputs, tmp_paths):
+            moveIntoPlace(tmp_path, output_path)
+
+        output_paths = [output_path for output_path, _ in outputs]
+        self.__removeStaleStyleSheets(output_dir, output_paths)
+        self.__measurement.bytes_out += sum(output_path.stat().st_size for output_path in output_paths)
+
+        if self.__assets is None:
+            removeAssets(output_dir)
+            return
+        with measurePhase(self.__measurement, 'precompress'):
+            for output_path, weight in outputs:
+                self.__assets.addStyleSheet(output_path, weight)
+        self.__assets.write()
+
+    def __openTemporary(self, output_dir: Path, tmp_paths: List[Path]) -> TextIO:
+        tmp_io = NamedTemporaryFile(
+            'w', encoding='utf-8', newline='', dir=output_dir, prefix='.style.', suffix='.tmp', delete=False
         )
+        tmp_paths.append(Path(tmp_io.name))
+        return tmp_io
 
-        for unicodes_file in FILE_DIR.UNICODE_TEXT.glob('./**/*.txt'):
-            idx = unicodes_file.stem
-            with open(unicodes_file, 'r') as fd:
-                style += pystache.render(
-                    BASE_TEMPLATE,
-                    {
-                        'package': package,
-                        'weight_number': weight_number,
-                        'unicodes': fd.read().replace('\n', ','),
-                        'font_base_path': f"./{package.version}/{weight}/{idx}",
-                    },
-                )
-        return style
+    def __writeStyleForWeight(self, weight: str, font: Font, streams: List[TextIO]) -> None:
+        package = self.__core.package
+        weight_number = getattr(WEIGHT_NUMBER, weight)
+        with measurePhase(self.__measurement, 'local_names'):
+            local_name_list = self.__getLocalFamilyName(font)
+
+        with measurePhase(self.__measurement, 'minify'):
+            local_rule = minifyRule(
+                'local',
+                {
+                    'package': package,
+                    'weight_number': weight_number,
+                    'local_src': ','.join(map(lambda n: f"local('{n}')", local_name_list)),
+                },
+            ) if len(local_name_list) != 0 else ''
+            base_rule = minifyRule(
+                'base',
+                {
+                    'package': package,
+                    'weight_number': weight_number,
+                    'unicodes': UNICODES_PLACEHOLDER,
+                    'font_base_path': FONT_BASE_PATH_PLACEHOLDER,
+                },
+            )
+
+        with measurePhase(self.__measurement, 'render'):
+            for stream in streams:
+                stream.write(local_rule)
+            for group in self.__getUnicodeGroups(font):
+                if self.__assets is not None:
+                    font_base_path = self.__assets.addSubset(weight, group.idx)
+                else:
+                    font_base_path = f"./{package.version}/{weight}/{group.idx}"
+                rule = base_rule.replace(FONT_BASE_PATH_PLACEHOLDER, font_base_path)
+                rule = rule.replace(UNICODES_PLACEHOLDER, group.unicode_range)
+                for stream in streams:
+                    stream.write(rule)
+
+    def __removeStaleStyleSheets(self, output_dir: Path, output_paths: List[Path]) -> None:
+        # Stylesheets of weights which are removed, or all of them when they are no longer split
+        for style_path in output_dir.glob('style.*.min.css'):
+            if style_path not in output_paths:
+                style_path.unlink()
+
+    def __getUnicodeGroups(self, font: Font) -> UnicodeGroupIndex:
+        if self.__group_budget is None:
+            return getCoveredUnicodeGroups(self.__core.unicode_groups, self.__core.getFontMetadata(font).codepoints)
+        # Adaptive groups depend on glyph sizes, so the font itself is read
+        ttfont = self.__core.fonts.open(self.__core.findFontfilePath(font), font.number)
+        return getFontUnicodeGroups(ttfont, self.__core.unicode_groups, self.__group_budget)
 
     def __getLocalFamilyName(self, font: Font) -> List[str]:
+        metadata = self.__core.getFontMetadata(font)
+        if font.variations is not None:
+            return self.__getInstanceLocalFamilyName(font, metadata)
+
+        family_name_set: Set[str] = set()
+
+        family_name = metadata.getName(NAME_ID.LEGACY_FAMILY)
+        weight_name = metadata.getName(NAME_ID.LEGACY_SUBFAMILY)
+        if family_name is not None and weight_name is not None:
+            family_name_set.add(f"{family_name} {weight_name}")
+            family_name_set.add(f"{family_name}-{weight_name}")
+
+        for name_id in [NAME_ID.POSTSCRIPT_NAME, NAME_ID.FULL_NAME]:
+            name = metadata.getName(name_id)
+            if name is not None:
+                family_name_set.add(name)
+
+        return list(family_name_set)
+
+    def __getInstanceLocalFamilyName(self, font: Font, metadata: FontMetadata) -> List[str]:
+        # Names of the default instance belong to another weight, so only a named instance can be matched locally
+        instance = metadata.findInstance(font.variations)
+        if instance is None:
+            return []
+
         family_name_set: Set[str] = set()
-        font_path = self.__core.findFontfilePath(font)
-
-        with TTFont(file=font_path, lazy=True, fontNumber=font.number) as ttfont:
-
-            def getName(name_id):
-                return ttfont['name'].getName(
-                    nameID=name_id,
-                    platformID=3,
-                    platEncID=1,
-                    langID=0x409,
-                )
-
-            name_record = getName(NAME_ID.LEGACY_FAMILY)
-            weight_record = getName(NAME_ID.LEGACY_SUBFAMILY)
-            if name_record is not None and weight_record is not None:
-                family_name_set.add(f"{name_record.toUnicode()} {weight_record.toUnicode()}")
-                family_name_set.add(f"{name_record.toUnicode()}-{weight_record.toUnicode()}")
-
-            name_record = getName(NAME_ID.POSTSCRIPT_NAME)
-            if name_record is not None:
-                family_name_set.add(name_record.toUnicode())
-            name_record = getName(NAME_ID.FULL_NAME)
-            if name_record is not None:
-                family_name_set.add(name_record.toUnicode())
+        family_name = metadata.getName(NAME_ID.PREFERRED_FAMILY) or metadata.getName(NAME_ID.LEGACY_FAMILY)
+        weight_name = metadata.getName(instance.subfamily_name_id)
+        if family_name is not None and weight_name is not None:
+            family_name_set.add(f"{family_name} {weight_name}")
+            family_name_set.add(f"{family_name}-{weight_name}")
+
+        if instance.postscript_name_id is not None:
+            name = metadata.getName(instance.postscript_name_id)
+            if name is not None:
+                family_name_set.add(name)
 
         return list(family_name_set)
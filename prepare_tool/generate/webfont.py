@@ -1,117 +1,376 @@
-import yaml
-from typing import List
-from xml.etree.ElementTree import Element, tostring as to_xml_string
-from faker import Faker
-from fontTools.subset import Options, Subsetter, load_font, save_font, parse_unicodes
+import zlib
+import brotli
+import cProfile
+import threading
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from copy import copy
+from dataclasses import dataclass
+from functools import lru_cache
+from io import BytesIO
+from pathlib import Path
+from typing import Deque, Iterator, List, Optional, Sequence, Set, Tuple
+from fontTools.subset import Options, Subsetter, load_font, save_font
+from fontTools.ttLib import TTFont, sfnt, woff2
 from fontTools.ttLib.sfnt import WOFFFlavorData
 from fontTools.ttLib.woff2 import WOFF2FlavorData
 
 from prepare_tool.core import Core
-from prepare_tool.models import Font
-from prepare_tool.const import FILE_DIR, NAME_ID, FAMILY_RELATED_NAME_ID
+from prepare_tool.cache import OutputCache
+from prepare_tool.models import Font, Source
+from prepare_tool.const import (
+    COMPRESSION_PROFILES, DEFAULT_COMPRESSION_PROFILE, NAME_ID, FAMILY_RELATED_NAME_ID, CompressionProfile
+)
+from prepare_tool.fonts.subset import SubsetSettings
+from prepare_tool.unicodes import UnicodeGroupIndex
+from prepare_tool.unicodes.adaptive import getCoveredUnicodeGroups, getFontUnicodeGroups
+from prepare_tool.plan import BuildPlan, STAGE_WEBFONT
+from prepare_tool.report import BuildReport, Measurement, measurePhase, measureTime
+
+MAX_PENDING_TASKS_PER_JOB = 4
+
+
+@dataclass()
+class SubsetTask():
+    package: str
+    weight: str
+    idx: str
+    font_path: Path
+    options: Options
+    unicodes: Sequence[int]
+    subset_fontname: str
+    copyrights: List[str]
+    metadata: bytes
+    output_dir: Path
+    cache: Optional[OutputCache]
+    cache_key: str
+    compression: CompressionProfile = COMPRESSION_PROFILES[DEFAULT_COMPRESSION_PROFILE]
+    # Time and memory are only measured for a report or a profile
+    measure: bool = False
+    profile_dir: Optional[Path] = None
 
 
 class WebFontGenerator():
-    def __init__(self, core: Core) -> None:
+    def __init__(
+        self,
+        core: Core,
+        jobs: int = 1,
+        cache: Optional[OutputCache] = None,
+        executor: Optional[Executor] = None,
+        plan: Optional[BuildPlan] = None,
+        report: Optional[BuildReport] = None,
+        group_budget: Optional[int] = None,
+        compression_profile: str = DEFAULT_COMPRESSION_PROFILE,
+    ) -> None:
+        if compression_profile not in COMPRESSION_PROFILES:
+            raise Exception(f"{compression_profile} is invalid compression profile.")
+
         self.__core = core
+        self.__jobs = jobs
+        self.__cache = cache
+        self.__executor = executor
+        self.__plan = plan
+        self.__report = report
+        self.__group_budget = group_budget
+        self.__compression_profile = compression_profile
+        self.__own_executor: Optional[ProcessPoolExecutor] = None
+        self.__pending: Deque[Tuple[SubsetTask, Future]] = deque()
 
     def generate(self) -> None:
-        package = self.__core.package
+        try:
+            for source in self.__core.package.sources:
+                self.addSource(source)
+        except Exception:
+            self.cancel()
+            raise
+        self.finish()
+
+    def addSource(self, source: Source) -> None:
+        '''
+        Start generating subsets of a source. With worker processes, this returns while they are still running.
+        '''
+        for weight, font in source.fonts:
+            if font is None:
+                continue
+            if self.__plan is not None and not self.__plan.shouldBuild(STAGE_WEBFONT, weight=weight):
+                continue
+            for task in self.__createTasksForWeight(weight=weight, font=font):
+                self.__submitTask(task)
+
+    def finish(self) -> None:
+        try:
+            while len(self.__pending) != 0:
+                self.__waitOldestTask()
+        finally:
+            self.__shutdown()
+
+        if self.__cache is not None:
+            self.__cache.evict()
+
+    def cancel(self) -> None:
+        for _, future in self.__pending:
+            future.cancel()
+        self.__pending.clear()
+        self.__shutdown()
+
+    def __submitTask(self, task: SubsetTask) -> None:
+        if self.__executor is None and self.__jobs == 1:
+            self.__addMeasurement(self.__runTask(task))
+            return
+
+        if self.__executor is None:
+            self.__executor = self.__own_executor = createWorkerPool(self.__jobs)
+        self.__pending.append((task, self.__executor.submit(generateSubset, task)))
+
+        # Backpressure, so that tasks and their results do not pile up while sources are still being prepared
+        while len(self.__pending) > max(self.__jobs, 1) * MAX_PENDING_TASKS_PER_JOB:
+            self.__waitOldestTask()
+
+    def __waitOldestTask(self) -> None:
+        task, future = self.__pending.popleft()
+        try:
+            self.__addMeasurement(self.__waitTask(task, future))
+        except Exception:
+            self.cancel()
+            raise
 
-        for source in package.sources:
-            for weight, font in source.fonts:
-                if font is None:
-                    continue
-                self.__generateForWeight(weight=weight, font=font)
+    def __shutdown(self) -> None:
+        if self.__own_executor is not None:
+            self.__own_executor.shutdown(wait=True)
+            self.__executor = self.__own_executor = None
 
-    def __generateForWeight(self, weight: str, font: Font) -> None:
+    def __runTask(self, task: SubsetTask) -> Measurement:
+        try:
+            return generateSubset(task)
+        except Exception as error:
+            raise Exception(f"Failed to generate subset {task.idx} of {task.weight}: {error}") from error
+
+    def __waitTask(self, task: SubsetTask, future: Future) -> Measurement:
+        try:
+            return future.result()
+        except Exception as error:
+            raise Exception(f"Failed to generate subset {task.idx} of {task.weight}: {error}") from error
+
+    def __addMeasurement(self, measurement: Measurement) -> None:
+        if self.__report is None:
+            return
+        measurement.package = self.__core.package.id
+        self.__report.add(measurement)
+
+    def __createTasksForWeight(self, weight: str, font: Font) -> List[SubsetTask]:
         package = self.__core.package
         base_dir = self.__core.directories.webfonts
         output_dir = base_dir.joinpath(f"./{package.version}/{weight}")
         font_path = self.__core.findFontfilePath(font)
+        if font.variations is not None:
+            # Subsets are cut from a static instance at the coordinates of the weight
+            font_path = self.__core.fonts.instantiate(font_path, font.number, font.variations)
 
         output_dir.mkdir(parents=True, exist_ok=True)
-        metadata = self.__generateMetadata()
-
-        fake = Faker()
-        fake.seed(package.id)
-        subset_fontname: str = fake.name()
-
-        options = Options()
-        options.font_number = font.number
-        options.hinting = False
-        options.desubroutinize = True
-        options.drop_tables += [
-            'FFTM', 'PfEd', 'TeX', 'BDF', 'cvt', 'fpgm', 'prep', 'gasp', 'VORG', 'CBDT', 'CBLC', 'sbix'
-        ]
-        for ignored in ['rvrn', 'locl']:
-            options.layout_features.remove(ignored)
-
-        for unicodes_file in FILE_DIR.UNICODE_TEXT.glob('./**/*.txt'):
-            idx = unicodes_file.stem
-            unicodes: List[str] = []
-
-            with open(unicodes_file, 'r') as unicode_read_io:
-                for line in unicode_read_io.readlines():
-                    unicodes.extend(parse_unicodes(line.split('#')[0]))
-
-            with load_font(font_path, options) as ttfont:
-                subsetter = Subsetter(options=options)
-                subsetter.populate(unicodes=unicodes)
-                subsetter.subset(ttfont)
-
-                for record in ttfont['name'].names:
-                    if record.nameID == NAME_ID.COPYRIGHT:
-                        record.string = '\n'.join(package.copyrights)
-                    elif record.nameID in FAMILY_RELATED_NAME_ID:
-                        record.string = subset_fontname
-
-                woff_file = output_dir.joinpath(f"{idx}.woff")
-                with open(woff_file, 'wb') as woff_write_io:
-                    options.flavor = 'woff'
-                    ttfont.flavorData = WOFFFlavorData()
-                    ttfont.flavorData.metaData = metadata
-                    save_font(ttfont, woff_write_io, options)
-
-                woff2_file = output_dir.joinpath(f"{idx}.woff2")
-                with open(woff2_file, 'wb') as woff2_write_io:
-                    options.flavor = 'woff2'
-                    ttfont.flavorData = WOFF2FlavorData()
-                    ttfont.flavorData.metaData = metadata
-                    save_font(ttfont, woff2_write_io, options)
-
-    def __generateMetadata(self) -> bytes:
-        package = self.__core.package
-        yaml_path = FILE_DIR.METADATA_TEMPLATE.joinpath(f"./{package.license}.yml")
-        if not yaml_path.exists():
-            raise Exception(f"{package.license} is invalid license id.")
-
-        with open(yaml_path, 'r', encoding='utf-8') as yaml_read_io:
-            data = yaml.safe_load(yaml_read_io.read())
-
-        root_el = self.__generateXMLElement(data['metadata'], 'metadata')
-        copyright_el = self.__generateXMLElement({}, 'copyright')
-        for copyright_text in package.copyrights:
-            copyright_el.append(self.__generateXMLElement({'_text': copyright_text}, 'text'))
-        root_el.append(copyright_el)
-
-        xml = to_xml_string(root_el, encoding='unicode')
-        return f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>{xml}'.encode('utf-8')
-
-    def __generateXMLElement(self, props: dict, tagname: str) -> Element:
-        el = Element(tagname)
-        if '_text' in props:
-            el.text = props['_text']
-        if '_attributes' in props:
-            el.attrib = props['_attributes']
-        for child_tagname, child_props_or_list in props.items():
-            if child_tagname.startswith('_'):
+        settings = SubsetSettings.create(package, font)
+
+        # Groups without any codepoint in the font are skipped, they would only contain .notdef.
+        groups = self.__getUnicodeGroups(font)
+        group_ids = {group.idx for group in groups}
+        self.__removeStaleSubsets(output_dir, group_ids)
+        if self.__plan is not None:
+            empty_group_ids = [group.idx for group in self.__core.unicode_groups if group.idx not in group_ids]
+            self.__plan.markEmpty(STAGE_WEBFONT, weight, empty_group_ids)
+
+        tasks: List[SubsetTask] = []
+        for group in groups:
+            if self.__plan is not None and not self.__plan.shouldBuild(STAGE_WEBFONT, weight=weight, group=group.idx):
                 continue
-            if not isinstance(child_props_or_list, list):
-                child_props_list = [child_props_or_list]
-            else:
-                child_props_list = child_props_or_list
-            for child_props in child_props_list:
-                child_el = self.__generateXMLElement(child_props, child_tagname)
-                el.append(child_el)
-        return el
+
+            tasks.append(
+                SubsetTask(
+                    package=package.id,
+                    weight=weight,
+                    idx=group.idx,
+                    font_path=font_path,
+                    options=settings.options,
+                    unicodes=group.codepoints,
+                    subset_fontname=settings.subset_fontname,
+                    copyrights=package.copyrights,
+                    metadata=settings.metadata,
+                    output_dir=output_dir,
+                    cache=self.__cache,
+                    cache_key=settings.createKey(package, font, group.digest, self.__compression_profile),
+                    compression=COMPRESSION_PROFILES[self.__compression_profile],
+                    measure=self.__report is not None,
+                    profile_dir=self.__report.profile_dir if self.__report is not None else None,
+                )
+            )
+        return tasks
+
+    def __getUnicodeGroups(self, font: Font) -> UnicodeGroupIndex:
+        if self.__group_budget is None:
+            return getCoveredUnicodeGroups(self.__core.unicode_groups, self.__core.getFontMetadata(font).codepoints)
+        # Adaptive groups depend on glyph sizes, so the font itself is read
+        ttfont = self.__core.fonts.open(self.__core.findFontfilePath(font), font.number)
+        return getFontUnicodeGroups(ttfont, self.__core.unicode_groups, self.__group_budget)
+
+    def __removeStaleSubsets(self, output_dir: Path, group_ids: Set[str]) -> None:
+        # Subsets of groups which are gone or became empty would be left behind.
+        for subset_file in [*output_dir.glob('*.woff'), *output_dir.glob('*.woff2')]:
+            if subset_file.stem not in group_ids:
+                subset_file.unlink()
+
+
+def createWorkerPool(jobs: int) -> ProcessPoolExecutor:
+    '''
+    Process pool for subsetting. Workers start lazily while download threads may be running,
+    so they are forked from a single-threaded forkserver instead of from this process.
+    '''
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(max_workers=jobs)
+
+    context = multiprocessing.get_context('forkserver')
+    # Imported once by the forkserver, so each worker starts with fontTools loaded
+    context.set_forkserver_preload([__name__])
+    return ProcessPoolExecutor(max_workers=jobs, mp_context=context)
+
+
+@lru_cache(maxsize=2)
+def readFontData(font_path: Path) -> bytes:
+    # Read the source font only once per weight and parse each subset lazily from memory.
+    # Copying a decompiled TTFont (deepcopy / pickle) is slower than lazily reparsing the raw SFNT.
+    with open(font_path, 'rb') as font_read_io:
+        return font_read_io.read()
+
+
+def generateSubset(task: SubsetTask) -> Measurement:
+    measurement = Measurement(stage='subset', weight=task.weight, group=task.idx)
+    if not task.measure:
+        writeSubset(task, measurement)
+        return measurement
+
+    with measureTime(measurement):
+        if task.profile_dir is None:
+            writeSubset(task, measurement)
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                writeSubset(task, measurement)
+            finally:
+                profiler.disable()
+                # Identical subsets of two packages share the cache key, so they are named by package and group
+                profiler.dump_stats(str(task.profile_dir.joinpath(f"{task.package}.{task.weight}.{task.idx}.prof")))
+    return measurement
+
+
+def writeSubset(task: SubsetTask, measurement: Measurement) -> None:
+    woff_file = task.output_dir.joinpath(f"{task.idx}.woff")
+    woff2_file = task.output_dir.joinpath(f"{task.idx}.woff2")
+    outputs = [('.woff', woff_file), ('.woff2', woff2_file)]
+
+    if task.cache is not None and task.cache.restore(task.cache_key, outputs):
+        measurement.cached = True
+        measurement.bytes_out = sum(output_file.stat().st_size for _, output_file in outputs)
+        return
+
+    for _, output_file in outputs:
+        # The previous output may be a hardlink into the cache.
+        if output_file.exists():
+            output_file.unlink()
+
+    options = copy(task.options)
+
+    with measurePhase(measurement, 'load'):
+        font_data = readFontData(task.font_path)
+        ttfont = load_font(BytesIO(font_data), options)
+    measurement.bytes_in = len(font_data)
+
+    with ttfont:
+        with measurePhase(measurement, 'subset'):
+            subsetter = Subsetter(options=options)
+            subsetter.populate(unicodes=task.unicodes)
+            subsetter.subset(ttfont)
+
+            for record in ttfont['name'].names:
+                if record.nameID == NAME_ID.COPYRIGHT:
+                    record.string = '\n'.join(task.copyrights)
+                elif record.nameID in FAMILY_RELATED_NAME_ID:
+                    record.string = task.subset_fontname
+
+        # Compile the subset only once, WOFF and WOFF2 are encoded from the same SFNT binary.
+        with measurePhase(measurement, 'compile'):
+            sfnt_io = BytesIO()
+            save_font(ttfont, sfnt_io, options)
+
+    # Compressors release the GIL, so both flavors are encoded at the same time.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(encodeWebFont, sfnt_io.getvalue(), 'woff', woff_file, task, measurement),
+            executor.submit(encodeWebFont, sfnt_io.getvalue(), 'woff2', woff2_file, task, measurement),
+        ]
+        for future in futures:
+            future.result()
+    measurement.bytes_out = sum(output_file.stat().st_size for _, output_file in outputs)
+
+    if task.cache is not None:
+        task.cache.store(task.cache_key, outputs)
+
+
+# Compression profile of the current encoder thread
+encoder_state = threading.local()
+fonttools_compress = sfnt.compress
+
+
+@lru_cache(maxsize=None)
+def installProfiledCompressors() -> None:
+    # fontTools has no options for compression, it calls sfnt.compress and woff2.brotli for tables and metadata.
+    # They are replaced once by compressors reading the profile of the calling thread, instead of replacing
+    # the level globals while other threads encode.
+    sfnt.compress = compressZlib
+    woff2.brotli = ProfiledBrotli()
+
+
+@contextmanager
+def useCompressionProfile(profile: CompressionProfile) -> Iterator[None]:
+    installProfiledCompressors()
+    encoder_state.profile = profile
+    try:
+        yield
+    finally:
+        encoder_state.profile = None
+
+
+def compressZlib(data: bytes, level: Optional[int] = None) -> bytes:
+    profile: Optional[CompressionProfile] = getattr(encoder_state, 'profile', None)
+    if profile is None:
+        return fonttools_compress(data) if level is None else fonttools_compress(data, level)
+    if profile.zopfli:
+        from zopfli.zlib import compress
+        return compress(data, numiterations=sfnt.ZOPFLI_LEVELS[profile.zlib_level])
+    return zlib.compress(data, profile.zlib_level)
+
+
+class ProfiledBrotli():
+    '''
+    Stands in for the brotli module used by fontTools.ttLib.woff2, compressing with the profile of the calling thread.
+    '''
+    def __getattr__(self, name: str):
+        return getattr(brotli, name)
+
+    def compress(self, data: bytes, mode: int = brotli.MODE_GENERIC) -> bytes:
+        profile: Optional[CompressionProfile] = getattr(encoder_state, 'profile', None)
+        if profile is None:
+            return brotli.compress(data, mode=mode)
+        return brotli.compress(data, mode=mode, quality=profile.brotli_quality, lgwin=profile.brotli_window)
+
+
+def encodeWebFont(sfnt_data: bytes, flavor: str, output_file: Path, task: SubsetTask, measurement: Measurement) -> None:
+    options = copy(task.options)
+    options.flavor = flavor
+
+    # Tables are not accessed, so they are copied from the SFNT binary without recompiling.
+    with measurePhase(measurement, flavor), useCompressionProfile(task.compression):
+        with TTFont(BytesIO(sfnt_data), lazy=True, recalcBBoxes=False, recalcTimestamp=False) as ttfont:
+            ttfont.flavorData = WOFF2FlavorData() if flavor == 'woff2' else WOFFFlavorData()
+            ttfont.flavorData.metaData = task.metadata
+            with open(output_file, 'wb') as write_io:
+                save_font(ttfont, write_io, options)
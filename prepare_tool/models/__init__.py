@@ -1,4 +1,4 @@
-from typing import Optional, List, Generator, Tuple
+from typing import Dict, Optional, List, Generator, Tuple
 from enum import Enum
 from pydantic import BaseModel, Field, AnyUrl, Extra
 
@@ -33,6 +33,7 @@ class Font(BaseModel):
     filename: str
     sha256: str
     number: int = Field(0)
+    variations: Optional[Dict[str, float]] = Field(None)
 
     class Config:
         extra = Extra.forbid
@@ -94,3 +95,34 @@ class Package(BaseModel):
         schema_extra = {
             '$schema': 'https://json-schema.org/draft-07/schema',
         }
+
+
+def constructPackage(json_dict: dict) -> Package:
+    '''
+    Build a package without validating it, for packages which are validated when they are generated.
+    '''
+    sources = [
+        Source.construct(
+            url=source['url'],
+            fonts=FontWeight.construct(
+                **{
+                    weight: Font.construct(**font)
+                    for weight, font in source['fonts'].items() if font is not None
+                }
+            ),
+        ) for source in json_dict['sources']
+    ]
+    fields = dict(json_dict)
+    # construct() does not resolve aliases
+    schema_url = fields.pop('$schema', None)
+    return Package.construct(
+        **{
+            **fields,
+            'schema_url': schema_url,
+            'sources': sources,
+            'features': Features.construct(**json_dict.get('features', {})),
+            'license': License(json_dict['license']),
+            'category': Category(json_dict['category']),
+            'characters': [Character(character) for character in json_dict['characters']],
+        }
+    )
@@ -0,0 +1,319 @@
+import json
+import hashlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from prepare_tool.core import Core
+from prepare_tool.models import Font
+from prepare_tool.const import FILE_DIR, ARCHIVE_EXTENSION, DEFAULT_COMPRESSION_PROFILE
+from prepare_tool.fonts.subset import SubsetSettings
+from prepare_tool.unicodes.adaptive import GROUPING_VERSION
+
+MANIFEST_VERSION = 1
+
+STAGE_ARCHIVE = 'archive'
+STAGE_WEBFONT = 'webfont'
+STAGE_STYLESHEET = 'stylesheet'
+
+
+@dataclass()
+class PlannedArtifact():
+    path: str
+    stage: str
+    inputs: str
+    reason: Optional[str]
+    weight: Optional[str] = None
+    group: Optional[str] = None
+    # Set when the font has no codepoint of the group, so no file is written
+    empty: bool = False
+
+    @property
+    def outdated(self) -> bool:
+        return self.reason is not None
+
+
+class BuildPlan():
+    def __init__(self, artifacts: List[PlannedArtifact], stale: List[PlannedArtifact]) -> None:
+        self.artifacts = artifacts
+        self.stale = stale
+
+    @property
+    def empty(self) -> bool:
+        return not any(artifact.outdated for artifact in self.artifacts)
+
+    def shouldBuild(self, stage: str, weight: Optional[str] = None, group: Optional[str] = None) -> bool:
+        # An artifact without group covers every subset of the weight
+        return any(
+            artifact.outdated and artifact.stage == stage and weight in (None, artifact.weight) and
+            (group is None or artifact.group in (None, group)) for artifact in self.artifacts
+        )
+
+    def markEmpty(self, stage: str, weight: str, groups: List[str]) -> None:
+        for artifact in self.artifacts:
+            if artifact.stage == stage and artifact.weight == weight and artifact.group in groups:
+                artifact.empty = True
+
+    def describe(self) -> str:
+        lines: List[str] = []
+        for stage in [STAGE_ARCHIVE, STAGE_WEBFONT, STAGE_STYLESHEET]:
+            artifacts = [artifact for artifact in self.artifacts if artifact.stage == stage]
+            if len(artifacts) == 0:
+                continue
+
+            weights = list(dict.fromkeys(artifact.weight for artifact in artifacts))
+            for weight in weights:
+                weight_artifacts = [artifact for artifact in artifacts if artifact.weight == weight]
+                outdated = [artifact for artifact in weight_artifacts if artifact.outdated]
+                label = stage if weight is None else f"{stage} {weight}"
+                if len(outdated) == 0:
+                    lines.append(f"{label}: up to date")
+                    continue
+
+                reasons = sorted(set(artifact.reason for artifact in outdated))
+                if len(weight_artifacts) == 1:
+                    lines.append(f"{label}: rebuild {outdated[0].path} ({', '.join(reasons)})")
+                else:
+                    lines.append(f"{label}: rebuild {len(outdated)}/{len(weight_artifacts)} ({', '.join(reasons)})")
+
+        # Stale entries are summarized like rebuilds, a version bump leaves every subset of the old version
+        for stage in [STAGE_ARCHIVE, STAGE_WEBFONT, STAGE_STYLESHEET]:
+            stale = [artifact for artifact in self.stale if artifact.stage == stage]
+            for weight in dict.fromkeys(artifact.weight for artifact in stale):
+                weight_stale = [artifact for artifact in stale if artifact.weight == weight]
+                label = stage if weight is None else f"{stage} {weight}"
+                if len(weight_stale) == 1:
+                    lines.append(f"{label}: stale {weight_stale[0].path}")
+                else:
+                    lines.append(f"{label}: {len(weight_stale)} stale")
+        return '\n'.join(lines)
+
+
+class BuildPlanner():
+    '''
+    Compares input hashes of every artifact with the manifest written by the last build.
+    '''
+    def __init__(
+        self,
+        core: Core,
+        stages: List[str],
+        force: bool = False,
+        archive_format: str = 'gz',
+        group_budget: Optional[int] = None,
+        split_css: bool = False,
+        compression_profile: str = DEFAULT_COMPRESSION_PROFILE,
+        hashed_assets: bool = False,
+    ) -> None:
+        self.__core = core
+        self.__stages = stages
+        self.__force = force
+        self.__archive_format = archive_format
+        self.__group_budget = group_budget
+        self.__split_css = split_css
+        self.__compression_profile = compression_profile
+        self.__hashed_assets = hashed_assets
+
+    @property
+    def manifest_path(self) -> Path:
+        return self.__core.directories.manifests.joinpath(f"./{self.__core.package.id}.json")
+
+    def plan(self) -> BuildPlan:
+        previous = self.__loadManifest()
+        artifacts: List[PlannedArtifact] = []
+
+        for path, stage, inputs, weight, group in self.__collectArtifacts():
+            previous_entry = previous.get(path)
+            if self.__force:
+                reason: Optional[str] = 'forced'
+            elif previous_entry is None:
+                reason = 'new'
+            elif previous_entry['inputs'] != inputs:
+                reason = 'changed'
+            elif not previous_entry.get('empty', False) and not self.__exists(stage, path):
+                reason = 'missing'
+            else:
+                reason = None
+            empty = reason is None and previous_entry.get('empty', False)
+            artifacts.append(PlannedArtifact(path, stage, inputs, reason, weight, group, empty))
+
+        planned_paths = {artifact.path for artifact in artifacts}
+        stale = [
+            PlannedArtifact(path, entry['stage'], entry['inputs'], 'stale', entry.get('weight'), entry.get('group'))
+            for path, entry in previous.items() if entry['stage'] in self.__stages and path not in planned_paths
+        ]
+        return BuildPlan(artifacts, stale)
+
+    def saveManifest(self, plan: BuildPlan) -> None:
+        # Entries of stages which were not built this time are kept as is.
+        manifest = {path: entry for path, entry in self.__loadManifest().items() if entry['stage'] not in self.__stages}
+        for artifact in plan.artifacts:
+            manifest[artifact.path] = {
+                'stage': artifact.stage,
+                'inputs': artifact.inputs,
+                'weight': artifact.weight,
+                'group': artifact.group,
+                'empty': artifact.empty,
+            }
+            if artifact.stage == STAGE_WEBFONT:
+                manifest[artifact.path]['compression_profile'] = self.__compression_profile
+
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.manifest_path, 'w', encoding='utf-8') as manifest_write_io:
+            data = {'version': MANIFEST_VERSION, 'id': self.__core.package.id, 'artifacts': manifest}
+            manifest_write_io.write(json.dumps(data, indent=2, sort_keys=True))
+
+    def __loadManifest(self) -> Dict[str, dict]:
+        if not self.manifest_path.is_file():
+            return {}
+        with open(self.manifest_path, 'r', encoding='utf-8') as manifest_read_io:
+            data = json.loads(manifest_read_io.read())
+        if data.get('version') != MANIFEST_VERSION:
+            return {}
+        return data['artifacts']
+
+    def __exists(self, stage: str, path: str) -> bool:
+        output_dir = self.__core.directories.output
+        if stage == STAGE_WEBFONT and self.__group_budget is not None:
+            return output_dir.joinpath(path).is_dir() and any(output_dir.joinpath(path).glob('*.woff2'))
+        if stage == STAGE_WEBFONT:
+            return all(output_dir.joinpath(f"{path}{suffix}").is_file() for suffix in ['.woff', '.woff2'])
+        return output_dir.joinpath(path).is_file()
+
+    def __collectArtifacts(self) -> Iterator[Tuple[str, str, str, Optional[str], Optional[str]]]:
+        package = self.__core.package
+        fonts = [(weight, font) for source in package.sources for weight, font in source.fonts if font is not None]
+        font_inputs = [
+            (weight, font.filename, font.sha256, font.number, *variationInputs(font)) for weight, font in fonts
+        ]
+        groups = self.__core.unicode_groups
+
+        if STAGE_ARCHIVE in self.__stages:
+            yield (
+                f"archives/{package.id}.{ARCHIVE_EXTENSION[self.__archive_format]}",
+                STAGE_ARCHIVE,
+                hashInputs(
+                    fonts=font_inputs,
+                    copyrights=package.copyrights,
+                    license_template=hashFile(FILE_DIR.LICENSE_TEMPLATE.joinpath(f"./{package.license.value}.txt")),
+                ),
+                None,
+                None,
+            )
+
+        # Stylesheets with hashed assets refer to the contents of subsets, so they are hashed with their inputs
+        webfont_artifacts: List[Tuple[str, str, str, Optional[str], Optional[str]]] = []
+        if STAGE_WEBFONT in self.__stages or (STAGE_STYLESHEET in self.__stages and self.__hashed_assets):
+            webfont_artifacts = list(self.__collectWebFontArtifacts(fonts))
+        if STAGE_WEBFONT in self.__stages:
+            yield from webfont_artifacts
+
+        if STAGE_STYLESHEET in self.__stages:
+            templates = [
+                FILE_DIR.STYLESHEETS_TEMPLATE.joinpath(f"./{name}.css")
+                for name in ['base', 'local', package.license.value]
+            ]
+            style_options: Dict[str, Any] = {}
+            if self.__group_budget is not None:
+                style_options['group_budget'] = self.__group_budget
+            subset_inputs: Dict[Optional[str], List[str]] = {}
+            if self.__hashed_assets:
+                style_options['hashed_assets'] = True
+                for _, _, inputs, weight, _ in webfont_artifacts:
+                    subset_inputs.setdefault(weight, []).append(inputs)
+            template_hashes = [hashFile(template) for template in templates]
+            group_inputs = [(group.idx, group.digest) for group in groups]
+            yield (
+                f"webfonts/{package.id}/style.min.css",
+                STAGE_STYLESHEET,
+                hashInputs(
+                    name=package.name,
+                    version=package.version,
+                    fonts=font_inputs,
+                    groups=group_inputs,
+                    templates=template_hashes,
+                    **style_options,
+                    **subsetInputs(subset_inputs, [weight for weight, _ in fonts]),
+                ),
+                None,
+                None,
+            )
+            if self.__split_css:
+                for font_input in font_inputs:
+                    weight = font_input[0]
+                    yield (
+                        f"webfonts/{package.id}/style.{weight}.min.css",
+                        STAGE_STYLESHEET,
+                        hashInputs(
+                            name=package.name,
+                            version=package.version,
+                            fonts=[font_input],
+                            groups=group_inputs,
+                            templates=template_hashes,
+                            **style_options,
+                            **subsetInputs(subset_inputs, [weight]),
+                        ),
+                        weight,
+                        None,
+                    )
+
+    def __collectWebFontArtifacts(
+        self, fonts: List[Tuple[str, Font]]
+    ) -> Iterator[Tuple[str, str, str, Optional[str], Optional[str]]]:
+        package = self.__core.package
+        groups = self.__core.unicode_groups
+
+        for weight, font in fonts:
+            # Hashed the same way as the output cache key of each subset
+            settings = SubsetSettings.create(package, font)
+            if self.__group_budget is not None:
+                # Adaptive groups are only known after reading the font, so the weight is planned as a whole.
+                yield (
+                    f"webfonts/{package.id}/{package.version}/{weight}",
+                    STAGE_WEBFONT,
+                    settings.createKey(
+                        package,
+                        font,
+                        [group.digest for group in groups],
+                        self.__compression_profile,
+                        group_budget=self.__group_budget,
+                        grouping_version=GROUPING_VERSION,
+                    ),
+                    weight,
+                    None,
+                )
+                continue
+
+            for group in groups:
+                yield (
+                    f"webfonts/{package.id}/{package.version}/{weight}/{group.idx}",
+                    STAGE_WEBFONT,
+                    settings.createKey(package, font, group.digest, self.__compression_profile),
+                    weight,
+                    group.idx,
+                )
+
+
+def subsetInputs(subset_inputs: Dict[Optional[str], List[str]], weights: List[str]) -> Dict[str, Any]:
+    if len(subset_inputs) == 0:
+        return {}
+    return {'subsets': [inputs for weight in weights for inputs in subset_inputs.get(weight, [])]}
+
+
+def variationInputs(font: Font) -> List[Dict[str, float]]:
+    return [] if font.variations is None else [font.variations]
+
+
+def hashInputs(**inputs: Any) -> str:
+    '''
+    Inputs added along with a new option are only passed while the option is set, e.g. group_budget,
+    so hashes in manifests and cache keys written before the option existed stay valid.
+    '''
+    serialized = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+def hashFile(file_path: Path) -> Optional[str]:
+    if not file_path.is_file():
+        return None
+    with open(file_path, 'rb') as fd:
+        return hashlib.sha256(fd.read()).hexdigest()
@@ -0,0 +1,218 @@
+import sys
+import json
+import time
+import pstats
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is reported as null there.
+    resource = None  # type: ignore
+
+if TYPE_CHECKING:
+    from prepare_tool.fonts.metadata import FontMetadata
+
+REPORT_VERSION = 1
+MiB = 1024 * 1024
+
+# Scopes of peak_rss. Without a way to reset the high-water mark, the peak covers the process up to then.
+PEAK_RSS_SCOPE_MEASUREMENT = 'measurement'
+PEAK_RSS_SCOPE_PROCESS = 'process'
+
+
+@dataclass()
+class Measurement():
+    stage: str
+    package: Optional[str] = None
+    weight: Optional[str] = None
+    group: Optional[str] = None
+    wall_time: float = 0.0
+    cpu_time: float = 0.0
+    peak_rss: Optional[int] = None
+    peak_rss_scope: Optional[str] = None
+    bytes_in: int = 0
+    bytes_out: int = 0
+    cached: bool = False
+    phases: Dict[str, float] = field(default_factory=dict)
+
+
+class BuildReport():
+    '''
+    Collects wall time, CPU time, peak RSS and bytes in/out of every stage and every subset.
+    '''
+    def __init__(self, profile: bool = False) -> None:
+        self.measurements: List[Measurement] = []
+        self.fonts: List[dict] = []
+
+        self.__profile_directory = TemporaryDirectory(prefix='openfontsjp-profile-') if profile else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.cleanup()
+
+    def cleanup(self) -> None:
+        if self.__profile_directory is not None:
+            self.__profile_directory.cleanup()
+
+    @property
+    def profile_dir(self) -> Optional[Path]:
+        if self.__profile_directory is None:
+            return None
+        return Path(self.__profile_directory.name)
+
+    @contextmanager
+    def measure(self, stage: str, package: Optional[str] = None) -> Iterator[Measurement]:
+        measurement = Measurement(stage=stage, package=package)
+        with measureTime(measurement):
+            yield measurement
+        self.measurements.append(measurement)
+
+    def add(self, measurement: Measurement) -> None:
+        self.measurements.append(measurement)
+
+    def addFont(self, package: str, weight: str, sha256: str, metadata: 'FontMetadata') -> None:
+        self.fonts.append(
+            {
+                'package': package,
+                'weight': weight,
+                'sha256': sha256,
+                'glyph_count': metadata.glyph_count,
+                'codepoint_count': len(metadata.codepoints),
+                'tables': metadata.tables,
+            }
+        )
+
+    def summary(self) -> str:
+        rows: Dict[str, List[Measurement]] = {}
+        for measurement in self.measurements:
+            rows.setdefault(measurement.stage, []).append(measurement)
+
+        lines = [
+            f"{'stage':<16} {'count':>6} {'wall(s)':>9} {'cpu(s)':>9} {'peak rss(MiB)':>14} "
+            f"{'in(MiB)':>9} {'out(MiB)':>9}"
+        ]
+        process_scoped = False
+        for stage, measurements in rows.items():
+            peak_rss = [m.peak_rss for m in measurements if m.peak_rss is not None]
+            # Marked when the peak could not be reset for the stage and covers the process up to its end
+            mark = '*' if any(m.peak_rss_scope == PEAK_RSS_SCOPE_PROCESS for m in measurements) else ' '
+            process_scoped = process_scoped or mark == '*'
+            lines.append(
+                f"{stage:<16} {len(measurements):>6} "
+                f"{sum(m.wall_time for m in measurements):>9.3f} "
+                f"{sum(m.cpu_time for m in measurements):>9.3f} "
+                f"{(max(peak_rss) / MiB if len(peak_rss) != 0 else 0):>13.1f}{mark} "
+                f"{sum(m.bytes_in for m in measurements) / MiB:>9.2f} "
+                f"{sum(m.bytes_out for m in measurements) / MiB:>9.2f}"
+            )
+
+            phases: Dict[str, float] = {}
+            for measurement in measurements:
+                for phase, elapsed in measurement.phases.items():
+                    phases[phase] = phases.get(phase, 0.0) + elapsed
+            for phase, elapsed in phases.items():
+                lines.append(f"  {phase:<14} {'':>6} {elapsed:>9.3f}")
+        if process_scoped:
+            lines.append('* peak rss of the process so far, it can not be reset on this platform')
+        return '\n'.join(lines)
+
+    def write(self, report_path: Path) -> None:
+        with open(report_path, 'w', encoding='utf-8') as report_write_io:
+            data = {
+                'version': REPORT_VERSION,
+                'measurements': [asdict(measurement) for measurement in self.measurements],
+                'fonts': self.fonts,
+            }
+            report_write_io.write(json.dumps(data, indent=2, ensure_ascii=False))
+
+    def writeProfile(self, profile_path: Path) -> None:
+        if self.profile_dir is None:
+            return
+        profile_files = sorted(str(profile_file) for profile_file in self.profile_dir.glob('*.prof'))
+        if len(profile_files) == 0:
+            return
+        pstats.Stats(*profile_files).dump_stats(str(profile_path))
+
+
+@contextmanager
+def measureStage(report: Optional[BuildReport], stage: str, package: Optional[str] = None) -> Iterator[Measurement]:
+    if report is None:
+        yield Measurement(stage=stage, package=package)
+        return
+    with report.measure(stage, package) as measurement:
+        yield measurement
+
+
+# Measurements in progress in this process. Their peaks so far are kept before a nested measurement resets the peak.
+running_measurements: List[Measurement] = []
+
+
+@contextmanager
+def measureTime(measurement: Measurement) -> Iterator[Measurement]:
+    for running_measurement in running_measurements:
+        keepPeakRSS(running_measurement)
+    reset = resetPeakRSS()
+    running_measurements.append(measurement)
+
+    started_at = time.perf_counter()
+    cpu_started_at = time.process_time()
+    try:
+        yield measurement
+    finally:
+        measurement.wall_time = time.perf_counter() - started_at
+        measurement.cpu_time = time.process_time() - cpu_started_at
+        running_measurements.remove(measurement)
+        keepPeakRSS(measurement)
+        if measurement.peak_rss_scope is None:
+            measurement.peak_rss_scope = PEAK_RSS_SCOPE_MEASUREMENT if reset else PEAK_RSS_SCOPE_PROCESS
+
+
+@contextmanager
+def measurePhase(measurement: Measurement, phase: str) -> Iterator[None]:
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        measurement.phases[phase] = measurement.phases.get(phase, 0.0) + time.perf_counter() - started_at
+
+
+def keepPeakRSS(measurement: Measurement) -> None:
+    peak_rss = getPeakRSS()
+    if peak_rss is not None:
+        measurement.peak_rss = max(measurement.peak_rss or 0, peak_rss)
+
+
+def resetPeakRSS() -> bool:
+    '''
+    Reset the peak resident set size to the current one. Only supported on Linux.
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs_io:
+            clear_refs_io.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def getPeakRSS() -> Optional[int]:
+    # Peak resident set size of the current process in bytes since the last resetPeakRSS
+    try:
+        with open('/proc/self/status', 'r') as status_io:
+            for line in status_io:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    # ru_maxrss can not be reset, it covers the whole lifetime of the process
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
@@ -0,0 +1,142 @@
+import os
+import json
+import zlib
+import hashlib
+from array import array
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import List, Optional, Sequence
+
+from prepare_tool.const import FILE_DIR
+
+INDEX_FORMAT_VERSION = 2
+INDEX_FILENAME = 'unicode-groups.json.zlib'
+
+
+@dataclass(frozen=True)
+class UnicodeGroup():
+    idx: str
+    codepoints: array
+    unicode_range: str
+    digest: str
+
+
+class UnicodeGroupIndex():
+    '''
+    Parsed groups/*.txt shared by all generators.
+    '''
+    def __init__(self, groups: List[UnicodeGroup]) -> None:
+        self.groups = groups
+
+    def __iter__(self):
+        return iter(self.groups)
+
+    def __len__(self) -> int:
+        return len(self.groups)
+
+    @classmethod
+    def build(cls, groups_dir: Path) -> 'UnicodeGroupIndex':
+        # Only needed when the index is not read from the cache directory
+        from fontTools.subset import parse_unicodes
+
+        groups: List[UnicodeGroup] = []
+        for unicodes_file in sorted(groups_dir.glob('./**/*.txt')):
+            with open(unicodes_file, 'r') as unicode_read_io:
+                unicodes_text = unicode_read_io.read()
+
+            codepoints = set()
+            for line in unicodes_text.splitlines():
+                codepoints.update(parse_unicodes(line.split('#')[0]))
+
+            groups.append(
+                UnicodeGroup(
+                    idx=unicodes_file.stem,
+                    codepoints=array('L', sorted(codepoints)),
+                    unicode_range=unicodes_text.replace('\n', ','),
+                    digest=hashlib.sha256(unicodes_text.encode('utf-8')).hexdigest(),
+                )
+            )
+        return cls(groups)
+
+    @classmethod
+    def load(cls, groups_dir: Path, index_path: Path) -> 'UnicodeGroupIndex':
+        '''
+        Read the index saved in index_path, or build and save it when groups_dir has changed since.
+        '''
+        fingerprint = cls.__fingerprint(groups_dir)
+        try:
+            with open(index_path, 'rb') as index_read_io:
+                data = json.loads(zlib.decompress(index_read_io.read()))
+            if data['version'] == INDEX_FORMAT_VERSION and data['fingerprint'] == fingerprint:
+                return cls(
+                    [
+                        UnicodeGroup(
+                            idx=group['idx'],
+                            codepoints=array('L', group['codepoints']),
+                            unicode_range=group['unicode_range'],
+                            digest=group['digest'],
+                        ) for group in data['groups']
+                    ]
+                )
+        except (OSError, zlib.error, ValueError, KeyError, TypeError):
+            pass
+
+        index = cls.build(groups_dir)
+        index.save(index_path, fingerprint)
+        return index
+
+    def save(self, index_path: Path, fingerprint: list) -> None:
+        groups = [
+            {
+                'idx': group.idx,
+                'codepoints': group.codepoints.tolist(),
+                'unicode_range': group.unicode_range,
+                'digest': group.digest,
+            } for group in self.groups
+        ]
+        data = {'version': INDEX_FORMAT_VERSION, 'fingerprint': fingerprint, 'groups': groups}
+        # Other processes sharing the cache directory never read a partially written index
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        with NamedTemporaryFile(dir=index_path.parent, prefix=f".{index_path.name}.", delete=False) as index_write_io:
+            try:
+                index_write_io.write(zlib.compress(json.dumps(data).encode('utf-8')))
+            except BaseException:
+                os.unlink(index_write_io.name)
+                raise
+        os.replace(index_write_io.name, index_path)
+
+    @staticmethod
+    def __fingerprint(groups_dir: Path) -> list:
+        fingerprint = []
+        for unicodes_file in sorted(groups_dir.glob('./**/*.txt')):
+            stat = unicodes_file.stat()
+            fingerprint.append([unicodes_file.name, stat.st_size, stat.st_mtime_ns])
+        return fingerprint
+
+
+def formatUnicodeRanges(codepoints: Sequence[int]) -> List[str]:
+    # Sorted codepoints to ranges in the notation of groups/*.txt, e.g. U+30a1-30f6
+    ranges: List[str] = []
+    if len(codepoints) == 0:
+        return ranges
+
+    start = end = codepoints[0]
+    for codepoint in list(codepoints[1:]) + [-1]:
+        if codepoint == end + 1:
+            end = codepoint
+            continue
+        ranges.append(f"U+{start:x}" if start == end else f"U+{start:x}-{end:x}")
+        start = end = codepoint
+    return ranges
+
+
+@lru_cache(maxsize=None)
+def getUnicodeGroupIndex(cache_dir: Optional[Path] = None) -> UnicodeGroupIndex:
+    '''
+    Groups parsed once per process. With cache_dir, the parsed index is also kept there across runs.
+    '''
+    if cache_dir is None:
+        return UnicodeGroupIndex.build(FILE_DIR.UNICODE_TEXT)
+    return UnicodeGroupIndex.load(FILE_DIR.UNICODE_TEXT, cache_dir.joinpath(INDEX_FILENAME))
@@ -0,0 +1,142 @@
+import hashlib
+from array import array
+from typing import TYPE_CHECKING, Collection, Dict, List, Optional, Set
+
+from prepare_tool.unicodes import UnicodeGroup, UnicodeGroupIndex, formatUnicodeRanges
+
+if TYPE_CHECKING:
+    from fontTools.ttLib import TTFont
+
+GROUPING_VERSION = 1
+# Bytes of hmtx and cmap entries added by every glyph
+GLYPH_OVERHEAD = 8
+
+
+class AdaptiveGrouper():
+    '''
+    Regroups unicodes covered by a font, so that each subset carries about byte_budget bytes of glyph data.
+    Glyphs reachable through GSUB substitutions count toward the codepoint which reaches them.
+    '''
+    def __init__(self, ttfont: 'TTFont', byte_budget: int) -> None:
+        self.__ttfont = ttfont
+        self.__byte_budget = byte_budget
+
+    def group(self, base_index: UnicodeGroupIndex) -> UnicodeGroupIndex:
+        cmap = self.__ttfont.getBestCmap() or {}
+        glyph_sizes = self.__getGlyphSizes(self.__ttfont)
+        substitutions = self.__getSubstitutions(self.__ttfont)
+
+        groups: List[UnicodeGroup] = []
+        assigned: Set[int] = set()
+        codepoints: List[int] = []
+        cost = 0
+
+        # Base groups are walked in order, so neighbouring ranges are merged and large ones are split.
+        for base_group in base_index:
+            for codepoint in base_group.codepoints:
+                if codepoint not in cmap or codepoint in assigned:
+                    continue
+                assigned.add(codepoint)
+
+                codepoint_cost = sum(
+                    glyph_sizes.get(glyph_name, 0) + GLYPH_OVERHEAD
+                    for glyph_name in closeGlyphs(cmap[codepoint], substitutions)
+                )
+                if len(codepoints) != 0 and cost + codepoint_cost > self.__byte_budget:
+                    groups.append(createUnicodeGroup(len(groups), codepoints))
+                    codepoints, cost = [], 0
+                codepoints.append(codepoint)
+                cost += codepoint_cost
+
+        if len(codepoints) != 0:
+            groups.append(createUnicodeGroup(len(groups), codepoints))
+        return UnicodeGroupIndex(groups)
+
+    def __getGlyphSizes(self, ttfont: 'TTFont') -> Dict[str, int]:
+        glyph_order = ttfont.getGlyphOrder()
+
+        if 'glyf' in ttfont:
+            loca = ttfont['loca']
+            return {glyph_name: loca[idx + 1] - loca[idx] for idx, glyph_name in enumerate(glyph_order)}
+
+        if 'CFF ' in ttfont:
+            cff = ttfont['CFF '].cff
+            charstrings = cff[cff.fontNames[0]].CharStrings
+            if charstrings.charStringsAreIndexed:
+                # Sizes are read from the INDEX offsets without decompiling charstrings
+                offsets = charstrings.charStringsIndex.offsets
+                return {
+                    glyph_name: offsets[idx + 1] - offsets[idx]
+                    for glyph_name, idx in charstrings.charStrings.items()
+                }
+
+        # Unknown outline format, only the number of glyphs is taken into account
+        return {glyph_name: 0 for glyph_name in glyph_order}
+
+    def __getSubstitutions(self, ttfont: 'TTFont') -> Dict[str, Set[str]]:
+        substitutions: Dict[str, Set[str]] = {}
+        if 'GSUB' not in ttfont or ttfont['GSUB'].table.LookupList is None:
+            return substitutions
+
+        for lookup in ttfont['GSUB'].table.LookupList.Lookup:
+            for subtable in lookup.SubTable:
+                if lookup.LookupType == 7:
+                    subtable = subtable.ExtSubTable
+                for glyph_name, alternates in iterSubstitutions(subtable):
+                    substitutions.setdefault(glyph_name, set()).update(alternates)
+        return substitutions
+
+
+def iterSubstitutions(subtable):
+    if subtable.LookupType == 1:
+        for glyph_name, alternate in subtable.mapping.items():
+            yield glyph_name, [alternate]
+    elif subtable.LookupType == 2:
+        for glyph_name, sequence in subtable.mapping.items():
+            yield glyph_name, sequence
+    elif subtable.LookupType == 3:
+        for glyph_name, alternates in subtable.alternates.items():
+            yield glyph_name, alternates
+    elif subtable.LookupType == 4:
+        for glyph_name, ligatures in subtable.ligatures.items():
+            yield glyph_name, [ligature.LigGlyph for ligature in ligatures]
+
+
+def closeGlyphs(glyph_name: str, substitutions: Dict[str, Set[str]]) -> Set[str]:
+    closure = {glyph_name}
+    pending = [glyph_name]
+    while len(pending) != 0:
+        for alternate in substitutions.get(pending.pop(), ()):
+            if alternate not in closure:
+                closure.add(alternate)
+                pending.append(alternate)
+    return closure
+
+
+def createUnicodeGroup(idx: int, codepoints: List[int]) -> UnicodeGroup:
+    sorted_codepoints = sorted(codepoints)
+    unicode_range = ','.join(formatUnicodeRanges(sorted_codepoints))
+    return UnicodeGroup(
+        idx=f"{idx:03d}",
+        codepoints=array('L', sorted_codepoints),
+        unicode_range=unicode_range,
+        digest=hashlib.sha256(unicode_range.encode('utf-8')).hexdigest(),
+    )
+
+
+def getFontUnicodeGroups(
+    ttfont: 'TTFont', base_index: UnicodeGroupIndex, byte_budget: Optional[int] = None
+) -> UnicodeGroupIndex:
+    '''
+    Groups which have at least one codepoint in the font. With byte_budget, the groups are regrouped adaptively.
+    '''
+    if byte_budget is not None:
+        return AdaptiveGrouper(ttfont, byte_budget).group(base_index)
+    return getCoveredUnicodeGroups(base_index, (ttfont.getBestCmap() or {}).keys())
+
+
+def getCoveredUnicodeGroups(base_index: UnicodeGroupIndex, codepoints: Collection[int]) -> UnicodeGroupIndex:
+    # Static groups only need the cmap, which is also kept in the font metadata
+    return UnicodeGroupIndex(
+        [group for group in base_index if any(codepoint in codepoints for codepoint in group.codepoints)]
+    )
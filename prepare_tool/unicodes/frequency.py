@@ -0,0 +1,79 @@
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterator, List, Set
+
+from prepare_tool.unicodes import UnicodeGroupIndex, formatUnicodeRanges
+
+CORPUS_CHUNK_SIZE = 1024 * 1024
+
+
+class CharacterFrequency():
+    '''
+    Character frequencies of a corpus. Every file of the corpus is counted as one page.
+    '''
+    def __init__(self) -> None:
+        self.counts: Counter = Counter()
+        self.pages: List[Set[int]] = []
+
+    def addFile(self, file_path: Path) -> None:
+        page: Set[str] = set()
+        with open(file_path, 'r', encoding='utf-8', errors='ignore') as corpus_read_io:
+            for chunk in iter(lambda: corpus_read_io.read(CORPUS_CHUNK_SIZE), ''):
+                # Counter counts a whole str in C, which is far faster than looping over characters in Python.
+                self.counts.update(chunk)
+                page.update(chunk)
+        self.pages.append({ord(char) for char in page})
+
+    def addCorpus(self, corpus_paths: List[Path]) -> None:
+        for file_path in iterCorpusFiles(corpus_paths):
+            self.addFile(file_path)
+
+    def countFetches(self, groups: List[List[int]]) -> float:
+        # Average number of subsets a page needs
+        if len(self.pages) == 0:
+            return 0.0
+        group_of: Dict[int, int] = {codepoint: idx for idx, codepoints in enumerate(groups) for codepoint in codepoints}
+        fetches = [len({group_of[codepoint] for codepoint in page if codepoint in group_of}) for page in self.pages]
+        return sum(fetches) / len(fetches)
+
+
+class FrequencyGrouper():
+    '''
+    Reorders codepoints of the current groups by frequency, so that frequent characters share the first subsets.
+    Characters which never appear in the corpus keep their current order.
+    '''
+    def __init__(self, index: UnicodeGroupIndex, group_size: int) -> None:
+        self.__index = index
+        self.__group_size = group_size
+
+    def group(self, frequency: CharacterFrequency) -> List[List[int]]:
+        order: Dict[int, int] = {}
+        for group in self.__index:
+            for codepoint in group.codepoints:
+                order.setdefault(codepoint, len(order))
+
+        codepoints = sorted(order.keys(), key=lambda codepoint: (-frequency.counts[chr(codepoint)], order[codepoint]))
+        return [
+            sorted(codepoints[start:start + self.__group_size])
+            for start in range(0, len(codepoints), self.__group_size)
+        ]
+
+
+def iterCorpusFiles(corpus_paths: List[Path]) -> Iterator[Path]:
+    for corpus_path in corpus_paths:
+        if corpus_path.is_dir():
+            yield from (file_path for file_path in sorted(corpus_path.glob('**/*')) if file_path.is_file())
+        else:
+            yield corpus_path
+
+
+def currentGroups(index: UnicodeGroupIndex) -> List[List[int]]:
+    return [list(group.codepoints) for group in index]
+
+
+def writeGroups(groups: List[List[int]], groups_dir: Path) -> None:
+    for unicodes_file in groups_dir.glob('*.txt'):
+        unicodes_file.unlink()
+    for idx, codepoints in enumerate(groups):
+        with open(groups_dir.joinpath(f"./{idx:03d}.txt"), 'w') as unicode_write_io:
+            unicode_write_io.write('\n'.join(formatUnicodeRanges(codepoints)))
@@ -1,7 +1,10 @@
 import hashlib
+from pathlib import Path
 
 from prepare_tool.core import Core
-from prepare_tool.models import Font
+from prepare_tool.models import Font, Source
+
+HASH_CHUNK_SIZE = 1024 * 1024
 
 
 class Validator():
@@ -12,16 +15,30 @@ class Validator():
         package = self.__core.package
 
         for source in package.sources:
-            for weight, font in source.fonts:
-                if font is None:
-                    continue
-                self.__validateFont(font)
+            self.validateSource(source)
+
+        return True
+
+    def validateSource(self, source: Source) -> bool:
+        for weight, font in source.fonts:
+            if font is None:
+                continue
+            self.__validateFont(font)
 
         return True
 
     def __validateFont(self, font: Font) -> None:
         font_path = self.__core.findFontfilePath(font)
-        with open(font_path, 'rb') as fd:
-            hash_hex = hashlib.sha256(fd.read()).hexdigest()
+        hash_hex = self.__core.file_hashes.get(font_path)
+        if hash_hex is None:
+            # Remembered for other faces of the same file
+            hash_hex = self.__core.file_hashes[font_path] = self.__hashFile(font_path)
         if font.sha256 != hash_hex:
             raise Exception(f'SHA256 of "{font_path.name}" is not matched.')
+
+    def __hashFile(self, file_path: Path) -> str:
+        sha256 = hashlib.sha256()
+        with open(file_path, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(HASH_CHUNK_SIZE), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
@@ -0,0 +1,284 @@
+import os
+import hashlib
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from threading import Thread
+from typing import Dict, List, Optional
+from unittest import mock
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+
+from prepare_tool.download import Fetcher, getMemberPath
+
+LAST_MODIFIED = 'Wed, 01 Jan 2020 00:00:00 GMT'
+FONT_FILENAMES = {'A.otf', 'B.otf'}
+DOWNLOAD_CHUNK_SIZE = 16 * 1024
+
+
+def createArchive() -> bytes:
+    archive_io = BytesIO()
+    with ZipFile(archive_io, mode='w') as archive:
+        archive.writestr('pad-a.bin', os.urandom(64 * 1024), compress_type=ZIP_STORED)
+        archive.writestr('fonts/A.otf', os.urandom(32 * 1024), compress_type=ZIP_DEFLATED)
+        archive.writestr('pad-b.bin', os.urandom(64 * 1024), compress_type=ZIP_STORED)
+        archive.writestr('fonts/B.otf', os.urandom(32 * 1024), compress_type=ZIP_DEFLATED)
+        archive.writestr('README.txt', b'readme' * 100, compress_type=ZIP_DEFLATED)
+    return archive_io.getvalue()
+
+
+def hashMembers(data: bytes) -> Dict[str, str]:
+    with ZipFile(BytesIO(data)) as archive:
+        return {
+            name: hashlib.sha256(archive.read(name)).hexdigest()
+            for name in archive.namelist() if name.startswith('fonts/')
+        }
+
+
+class ArchiveServer(ThreadingHTTPServer):
+    def __init__(self, data: bytes, ranges: bool = True, etag: Optional[str] = 'strong', last_modified: bool = True):
+        super().__init__(('127.0.0.1', 0), ArchiveHandler)
+        self.data = data
+        # Served instead of data after the first request, as if the file was replaced on the server
+        self.replaced_data: Optional[bytes] = None
+        self.ranges = ranges
+        self.etag = etag
+        self.last_modified = last_modified
+        # Status of every response, e.g. 404
+        self.error_status: Optional[int] = None
+        # The next full or partial response ends after this many bytes, as if the connection was lost
+        self.truncate_at: Optional[int] = None
+        self.requests: List[Dict[str, str]] = []
+        self.bytes_sent = 0
+
+    def getETag(self) -> Optional[str]:
+        if self.etag is None:
+            return None
+        etag = f"\"{hashlib.sha256(self.data).hexdigest()[:16]}\""
+        return f"W/{etag}" if self.etag == 'weak' else etag
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    server: ArchiveServer
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        server = self.server
+        server.requests.append(dict(self.headers))
+        data, etag = server.data, server.getETag()
+        if server.replaced_data is not None:
+            server.data = server.replaced_data
+
+        if server.error_status is not None:
+            self.send_error(server.error_status)
+            return
+        if etag is not None and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        start, end = 0, len(data) - 1
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        # Weak validators never match If-Range (RFC 7233)
+        if_range_matched = if_range is None or (
+            not if_range.startswith('W/') and if_range in (etag, LAST_MODIFIED if server.last_modified else None)
+        )
+        partial = server.ranges and range_header is not None and if_range_matched
+        if partial:
+            first, last = range_header[len('bytes='):].split('-')
+            if first == '':
+                start = max(0, len(data) - int(last))
+            else:
+                start, end = int(first), min(int(last or end), len(data) - 1)
+
+        self.send_response(206 if partial else 200)
+        if partial:
+            self.send_header('Content-Range', f"bytes {start}-{end}/{len(data)}")
+        if etag is not None:
+            self.send_header('ETag', etag)
+        if server.last_modified:
+            self.send_header('Last-Modified', LAST_MODIFIED)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        body = data[start:end + 1]
+        if server.truncate_at is not None:
+            body, server.truncate_at = body[:server.truncate_at], None
+        self.wfile.write(body)
+        server.bytes_sent += len(body)
+
+
+class ArchiveServerTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.data = createArchive()
+
+    def startServer(self, **options) -> ArchiveServer:
+        server = ArchiveServer(self.data, **options)
+        Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def getURL(self, server: ArchiveServer, name: str = 'archive.zip') -> str:
+        return f"http://127.0.0.1:{server.server_address[1]}/{name}"
+
+
+class FetcherTest(ArchiveServerTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        # Chunks smaller than the archive, so that a cut off download leaves a partial file
+        patcher = mock.patch('prepare_tool.download.DOWNLOAD_CHUNK_SIZE', DOWNLOAD_CHUNK_SIZE)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetch(self, server: ArchiveServer, cache_dir: Optional[Path] = None) -> bytes:
+        with Fetcher(cache_dir) as fetcher:
+            return fetcher.fetch(self.getURL(server), 'https://openfonts.jp/').read_bytes()
+
+    def test_resume(self):
+        server = self.startServer()
+        server.truncate_at = 4 * DOWNLOAD_CHUNK_SIZE
+        self.assertEqual(self.fetch(server), self.data)
+        # The second attempt continues from where the first one was cut off
+        self.assertEqual(len(server.requests), 2)
+        self.assertEqual(server.requests[1].get('Range'), f"bytes={4 * DOWNLOAD_CHUNK_SIZE}-")
+        self.assertEqual(server.bytes_sent, len(self.data))
+
+    def test_resume_answered_with_whole_file(self):
+        server = self.startServer(ranges=False)
+        server.truncate_at = 4 * DOWNLOAD_CHUNK_SIZE
+        self.assertEqual(self.fetch(server), self.data)
+        # The server ignored the range, so the partial download is replaced instead of appended to
+        self.assertEqual(len(server.requests), 2)
+        self.assertIn('Range', server.requests[1])
+        self.assertEqual(server.bytes_sent, 4 * DOWNLOAD_CHUNK_SIZE + len(self.data))
+
+    def test_revalidate_cache(self):
+        server = self.startServer()
+        with TemporaryDirectory() as cache_dir:
+            self.assertEqual(self.fetch(server, Path(cache_dir)), self.data)
+            self.assertEqual(self.fetch(server, Path(cache_dir)), self.data)
+        self.assertEqual(len(server.requests), 2)
+        self.assertEqual(server.requests[1].get('If-None-Match'), server.getETag())
+        self.assertEqual(server.bytes_sent, len(self.data))
+
+    def test_changed_cache(self):
+        server = self.startServer()
+        with TemporaryDirectory() as cache_dir:
+            self.assertEqual(self.fetch(server, Path(cache_dir)), self.data)
+            server.data = createArchive()
+            self.assertEqual(self.fetch(server, Path(cache_dir)), server.data)
+
+    def test_release(self):
+        server = self.startServer()
+        with Fetcher() as fetcher:
+            path = fetcher.fetch(self.getURL(server), 'https://openfonts.jp/')
+            fetcher.release(self.getURL(server))
+            self.assertFalse(path.exists())
+            # Fetched again when it is needed after it was released
+            self.assertEqual(fetcher.fetch(self.getURL(server), 'https://openfonts.jp/').read_bytes(), self.data)
+        self.assertEqual(len(server.requests), 2)
+
+    def test_release_retained(self):
+        server = self.startServer()
+        with Fetcher() as fetcher:
+            fetcher.retain([self.getURL(server)])
+            path = fetcher.fetch(self.getURL(server), 'https://openfonts.jp/')
+            fetcher.release(self.getURL(server))
+            self.assertTrue(path.exists())
+
+    def test_release_cached(self):
+        server = self.startServer()
+        with TemporaryDirectory() as cache_dir:
+            with Fetcher(Path(cache_dir)) as fetcher:
+                path = fetcher.fetch(self.getURL(server), 'https://openfonts.jp/')
+                fetcher.release(self.getURL(server))
+                self.assertTrue(path.exists())
+
+    def test_client_error_is_not_retried(self):
+        server = self.startServer()
+        server.error_status = 404
+        with self.assertRaisesRegex(Exception, '404'):
+            self.fetch(server)
+        self.assertEqual(len(server.requests), 1)
+
+    def test_server_error_is_retried(self):
+        server = self.startServer()
+        server.error_status = 503
+        with self.assertRaisesRegex(Exception, '503'):
+            self.fetch(server)
+        self.assertEqual(len(server.requests), 3)
+
+
+class RemoteArchiveTest(ArchiveServerTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        # The central directory is still in the tail, but members have to be streamed
+        patcher = mock.patch('prepare_tool.download.remote.TAIL_SIZE', 4 * 1024)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def hashRemote(self, server: ArchiveServer, name: str = 'archive.zip') -> Optional[Dict[str, str]]:
+        with Fetcher() as fetcher:
+            return fetcher.prefetchMemberHashes(self.getURL(server, name), 'https://openfonts.jp/',
+                                                FONT_FILENAMES).result()
+
+    def test_range_requests(self):
+        server = self.startServer()
+        self.assertEqual(self.hashRemote(server), hashMembers(self.data))
+        self.assertTrue(all('Range' in headers for headers in server.requests))
+        # The tail and both fonts, without the padding
+        self.assertEqual(len(server.requests), 3)
+        self.assertLess(server.bytes_sent, len(self.data) / 2)
+
+    def test_no_range_support(self):
+        server = self.startServer(ranges=False)
+        self.assertIsNone(self.hashRemote(server))
+        self.assertEqual(len(server.requests), 1)
+
+    def test_weak_etag(self):
+        server = self.startServer(etag='weak')
+        self.assertEqual(self.hashRemote(server), hashMembers(self.data))
+        self.assertEqual(server.requests[-1].get('If-Range'), LAST_MODIFIED)
+
+    def test_weak_etag_without_last_modified(self):
+        server = self.startServer(etag='weak', last_modified=False)
+        self.assertEqual(self.hashRemote(server), hashMembers(self.data))
+        self.assertNotIn('If-Range', server.requests[-1])
+
+    def test_file_changed(self):
+        server = self.startServer()
+        server.replaced_data = createArchive()
+        self.assertIsNone(self.hashRemote(server))
+
+    def test_file_changed_without_validators(self):
+        server = self.startServer(etag=None, last_modified=False)
+        server.replaced_data = self.data + b'\0'
+        self.assertIsNone(self.hashRemote(server))
+
+    def test_non_zip_source(self):
+        server = self.startServer()
+        self.assertIsNone(self.hashRemote(server, 'archive.tar.xz'))
+        self.assertEqual(len(server.requests), 0)
+
+
+class MemberPathTest(unittest.TestCase):
+    def test_member_in_directory(self):
+        with TemporaryDirectory() as tmp_dir:
+            base_dir = Path(tmp_dir)
+            self.assertEqual(getMemberPath(base_dir, 'fonts/A.otf'), base_dir.resolve().joinpath('fonts/A.otf'))
+            self.assertEqual(getMemberPath(base_dir, 'fonts/../A.otf'), base_dir.resolve().joinpath('A.otf'))
+
+    def test_member_outside_of_directory(self):
+        with TemporaryDirectory() as tmp_dir:
+            for filename in ['../A.otf', 'fonts/../../A.otf', '/tmp/A.otf']:
+                with self.assertRaisesRegex(Exception, 'outside of the archive'):
+                    getMemberPath(Path(tmp_dir), filename)
+
+
+if __name__ == '__main__':
+    unittest.main()